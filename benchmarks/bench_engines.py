@@ -0,0 +1,70 @@
+"""Confronto tra il motore a thread (default) e il motore asyncio.
+
+Avvia un server pyftpdlib locale con un albero misto (molti file piccoli e alcuni file grandi) e
+scarica tutto con entrambi i motori a diversi numeri di connessioni, riportando tempo, MB/s,
+file/s e tempo CPU del processo (che include anche il server, avviato nello stesso processo).
+
+    python benchmarks/bench_engines.py [--small 2000] [--large 8] [--large-size-mb 32] [--connections 8 32 128]
+"""
+import argparse
+import os
+import shutil
+import threading
+import time
+
+from ftp_fixture import LocalFTPServer, make_flat_tree, list_local_tree, temp_dir
+
+import ftp_backup
+from tqdm import tqdm
+
+
+def run_engine(engine, creds, items, dest, connections):
+    pbar = tqdm(total=sum(item[2] for item in items), unit='B', unit_scale=True, disable=True)
+    run = ftp_backup.BackupRun(creds, ftp_backup.STRINGS['en'], ftp_backup.WorkScheduler(connections), pbar)
+    for remote, rel, size, modify in items:
+        run.scheduler.put((remote, os.path.join(dest, rel), size, modify))
+    run.scheduler.close()
+
+    if engine == 'asyncio':
+        threads = [threading.Thread(target=ftp_backup.run_async_engine, args=(run, connections))]
+    else:
+        threads = [threading.Thread(target=ftp_backup.download_worker, args=(run, i)) for i in range(connections)]
+    start, cpu_start = time.perf_counter(), time.process_time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    run.pool.close()
+    return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--small', type=int, default=2000, help="numero di file da 4 KB")
+    parser.add_argument('--large', type=int, default=8, help="numero di file grandi")
+    parser.add_argument('--large-size-mb', type=int, default=32)
+    parser.add_argument('--connections', type=int, nargs='+', default=[8, 32, 128])
+    args = parser.parse_args()
+
+    source = temp_dir("src")
+    make_flat_tree(os.path.join(source, "small"), args.small, 4096)
+    make_flat_tree(os.path.join(source, "large"), args.large, args.large_size_mb * 1024 * 1024)
+    items = list_local_tree(source)
+    total_mb = sum(item[2] for item in items) / 1e6
+    print(f"Albero: {len(items)} file, {total_mb:.1f} MB")
+    print(f"{'motore':<8} {'conn':>5} {'tempo s':>8} {'MB/s':>8} {'file/s':>8} {'CPU s':>7}")
+    try:
+        with LocalFTPServer(source) as server:
+            for connections in args.connections:
+                for engine in ('threads', 'asyncio'):
+                    dest = temp_dir("dst")
+                    try:
+                        elapsed, cpu = run_engine(engine, server.credentials(), items, dest, connections)
+                    finally:
+                        shutil.rmtree(dest, ignore_errors=True)
+                    print(f"{engine:<8} {connections:>5} {elapsed:>8.2f} {total_mb / elapsed:>8.1f} "
+                          f"{len(items) / elapsed:>8.1f} {cpu:>7.2f}")
+    finally:
+        shutil.rmtree(source, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
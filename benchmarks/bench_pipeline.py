@@ -0,0 +1,141 @@
+"""Benchmark riproducibile dell'intera pipeline (scansione + download) su alberi sintetici.
+
+Avvia un server pyftpdlib locale, facoltativamente con latenza per comando e banda limitata per
+connessione, genera alberi di diverse forme (molti file minuscoli, pochi file enormi, cartelle
+annidate, cartelle larghe) ed esegue ftp_backup.py come processo separato, senza interazione,
+riportando file/s, MB/s, tempo al primo byte e picco di memoria (RSS) del processo di backup.
+Ogni risultato viene aggiunto a un file JSON lines insieme al commit e ai parametri, e
+confrontato con l'ultima esecuzione con gli stessi parametri.
+
+    python benchmarks/bench_pipeline.py [--shapes tiny huge deep wide] [--scale 1.0] [--workers 8]
+        [--engine threads] [--latency-ms 0] [--bandwidth 10M] [--repeat 1] [--args "--no-verify"]
+        [--results benchmarks/results/pipeline.jsonl]
+"""
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from ftp_fixture import BENCH_PASS, BENCH_USER, LocalFTPServer, TREE_SHAPES, make_tree, temp_dir
+
+import ftp_backup
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), "ftp_backup.py")
+DEFAULT_RESULTS = os.path.join(BENCH_DIR, "results", "pipeline.jsonl")
+# Parametri che devono coincidere perché due risultati siano confrontabili
+COMPARE_KEYS = ('shape', 'scale', 'engine', 'workers', 'latency_ms', 'bandwidth', 'args')
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(server, dest, args, extra_args):
+    """Un backup completo in un processo figlio; ritorna (riepilogo delle metriche, secondi, RSS massimo in byte, exit code)."""
+    metrics_file = os.path.join(dest, "metrics.jsonl")
+    command = [sys.executable, SCRIPT, "--host", "127.0.0.1", "--port", str(server.port), "--user", BENCH_USER,
+               "--output-dir", dest, "--workers", str(args.workers), "--engine", args.engine,
+               "--metrics", metrics_file, "--quiet", *extra_args]
+    env = {**os.environ, ftp_backup.PASSWORD_ENV_VAR: BENCH_PASS}
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    # wait4 restituisce le risorse di questo figlio soltanto (il server gira nel processo del benchmark)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    summary = {}
+    if os.path.exists(metrics_file):
+        with open(metrics_file, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record['event'] == 'summary': summary = record
+    return summary, elapsed, peak_rss, process.returncode
+
+
+def load_results(path):
+    if not os.path.exists(path): return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def speedup(seconds, previous):
+    """Variazione di velocità rispetto al risultato precedente (positiva = più veloce)."""
+    return f"{(previous['seconds'] / seconds - 1) * 100:+.1f}%" if previous and seconds else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shapes', nargs='+', choices=list(TREE_SHAPES), default=list(TREE_SHAPES))
+    parser.add_argument('--scale', type=float, default=1.0, help="moltiplica numero (o dimensione) dei file")
+    parser.add_argument('--workers', type=int, default=ftp_backup.DEFAULT_WORKERS)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="latenza simulata per comando FTP")
+    parser.add_argument('--bandwidth', metavar='RATE', help="banda per connessione dati, es. 10M (default: illimitata)")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--args', default="", help="opzioni aggiuntive per ftp_backup.py, es. \"--no-verify\"")
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help="file JSON lines dei risultati")
+    parser.add_argument('--no-save', action='store_true', help="non salvare i risultati")
+    args = parser.parse_args()
+
+    extra_args = shlex.split(args.args)
+    bandwidth = ftp_backup.parse_rate(args.bandwidth)
+    history = load_results(args.results)
+    commit = git_commit()
+    results = []
+    print(f"{'forma':<6} {'file':>7} {'MB':>8} {'tempo s':>8} {'file/s':>9} {'MB/s':>8} {'TTFB s':>7} "
+          f"{'scan s':>7} {'RSS MB':>7} {'vs prec.':>9}")
+    for shape in args.shapes:
+        source = temp_dir(f"src_{shape}")
+        try:
+            make_tree(source, shape, args.scale)
+            with LocalFTPServer(source, latency=args.latency_ms / 1000, bandwidth=bandwidth) as server:
+                for _ in range(args.repeat):
+                    dest = temp_dir("dst")
+                    try:
+                        summary, elapsed, peak_rss, exit_code = run_case(server, dest, args, extra_args)
+                    finally:
+                        shutil.rmtree(dest, ignore_errors=True)
+                    files, size = summary.get('files', 0), summary.get('bytes', 0)
+                    result = {
+                        'ts': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+                        'python': sys.version.split()[0], 'shape': shape, 'scale': args.scale, 'engine': args.engine,
+                        'workers': args.workers, 'latency_ms': args.latency_ms, 'bandwidth': bandwidth, 'args': args.args,
+                        'exit_code': exit_code, 'files': files, 'bytes': size, 'seconds': round(elapsed, 3),
+                        'files_per_second': round(files / elapsed, 1), 'mb_per_second': round(size / 1e6 / elapsed, 2),
+                        'ttfb_seconds': summary.get('first_byte_seconds'),
+                        'discovery_seconds': summary.get('phases', {}).get('discovery'),
+                        'peak_rss_mb': round(peak_rss / 1e6, 1),
+                    }
+                    previous = next((r for r in reversed(history) if r.get('exit_code') == 0 and
+                                     all(r.get(key) == result[key] for key in COMPARE_KEYS)), None)
+                    ttfb = f"{result['ttfb_seconds']:.3f}" if result['ttfb_seconds'] is not None else "-"
+                    scan = f"{result['discovery_seconds']:.2f}" if result['discovery_seconds'] is not None else "-"
+                    print(f"{shape:<6} {files:>7} {size / 1e6:>8.1f} {elapsed:>8.2f} {result['files_per_second']:>9.1f} "
+                          f"{result['mb_per_second']:>8.1f} {ttfb:>7} {scan:>7} {result['peak_rss_mb']:>7.1f} "
+                          f"{speedup(elapsed, previous):>9}"
+                          + (f"  (exit {exit_code})" if exit_code else ""))
+                    results.append(result)
+        finally:
+            shutil.rmtree(source, ignore_errors=True)
+
+    if results and not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+        with open(args.results, 'a', encoding="utf-8") as f:
+            for result in results: f.write(json.dumps(result) + "\n")
+        print(f"Risultati aggiunti a {args.results}" + (f" (commit {commit})" if commit else ""))
+
+
+if __name__ == "__main__":
+    main()
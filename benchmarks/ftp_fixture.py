@@ -0,0 +1,154 @@
+"""Server FTP locale (pyftpdlib) e generatori di alberi sintetici per i benchmark.
+
+Richiede `pip install pyftpdlib`.
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import DTPHandler, FTPHandler
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.log import config_logging
+from pyftpdlib.servers import ThreadedFTPServer
+
+# I benchmark importano ftp_backup.py dalla cartella superiore
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+config_logging(level=logging.WARNING)
+
+BENCH_USER = "bench"
+BENCH_PASS = "bench"
+PAYLOAD_BLOCK = 1024 * 1024  # I file grandi ripetono un blocco casuale: niente payload enorme in memoria
+
+
+class SlowFTPHandler(FTPHandler):
+    """Simula una rete lenta: ogni comando (e l'apertura della connessione) attende `latency`
+    secondi prima della risposta, come un round trip."""
+    latency = 0.0
+
+    def handle(self):
+        if self.latency: time.sleep(self.latency)
+        super().handle()
+
+    def pre_process_command(self, line, cmd, arg):
+        if self.latency: time.sleep(self.latency)
+        super().pre_process_command(line, cmd, arg)
+
+
+class ShapedDTPHandler(DTPHandler):
+    """Connessione dati limitata a `bandwidth` byte/s. A differenza di ThrottledDTPHandler, che
+    lascia passare raffiche di un secondo, attende dopo ogni invio quanto basta a restare in media."""
+    bandwidth = None
+
+    def __init__(self, sock, cmd_channel):
+        super().__init__(sock, cmd_channel)
+        self.shaping_start = None
+        self.shaped_bytes = 0
+
+    def use_sendfile(self):
+        return False
+
+    def send(self, data):
+        sent = super().send(data)
+        if sent:
+            if self.shaping_start is None: self.shaping_start = time.monotonic()
+            self.shaped_bytes += sent
+            ahead = self.shaped_bytes / self.bandwidth - (time.monotonic() - self.shaping_start)
+            if ahead > 0: time.sleep(ahead)
+        return sent
+
+
+class LocalFTPServer:
+    """Server pyftpdlib su 127.0.0.1 (porta libera) che esporta `root` in un thread in background.
+    `latency` (secondi per comando) e `bandwidth` (byte/s per connessione dati) simulano un server
+    remoto; ogni connessione ha un proprio thread, quindi l'attesa non blocca le altre."""
+    def __init__(self, root, max_cons=512, latency=0.0, bandwidth=None):
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(BENCH_USER, BENCH_PASS, root, perm="elr")
+        attrs = {'authorizer': authorizer, 'banner': "bench", 'latency': latency}
+        if bandwidth:
+            attrs['dtp_handler'] = type("BenchDTPHandler", (ShapedDTPHandler,), {'bandwidth': bandwidth})
+        handler = type("BenchHandler", (SlowFTPHandler,), attrs)
+        # IOLoop proprio: con quello globale, un server appena chiuso può chiudere anche il successivo
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), handler, ioloop=IOLoop())
+        self.server.max_cons = max_cons
+        self.port = self.server.address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'timeout': 0.5}, daemon=True)
+
+    def credentials(self):
+        return {'host': "127.0.0.1", 'port': self.port, 'user': BENCH_USER, 'pass': BENCH_PASS}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.close_all()
+        self.thread.join()
+
+
+def write_file(path, size, payload):
+    """Scrive `size` byte ripetendo `payload` (al massimo PAYLOAD_BLOCK byte)."""
+    with open(path, 'wb') as f:
+        for offset in range(0, size, len(payload)):
+            f.write(payload[:size - offset])
+
+
+def make_flat_tree(root, files, size, files_per_dir=1000):
+    """Crea `files` file da `size` byte, suddivisi in cartelle da `files_per_dir`."""
+    payload = os.urandom(max(1, min(size, PAYLOAD_BLOCK)))
+    for i in range(files):
+        directory = os.path.join(root, f"d{i // files_per_dir:04d}")
+        if i % files_per_dir == 0: os.makedirs(directory, exist_ok=True)
+        write_file(os.path.join(directory, f"f{i:06d}.bin"), size, payload)
+
+
+def make_deep_tree(root, depth, fanout, files_per_dir, size):
+    """Albero annidato: `fanout` sottocartelle per livello fino a `depth` livelli, con `files_per_dir`
+    file in ogni cartella. La scansione procede un livello alla volta."""
+    payload = os.urandom(max(1, min(size, PAYLOAD_BLOCK)))
+    def fill(directory, level):
+        os.makedirs(directory, exist_ok=True)
+        for i in range(files_per_dir): write_file(os.path.join(directory, f"f{i:03d}.bin"), size, payload)
+        if level < depth:
+            for i in range(fanout): fill(os.path.join(directory, f"l{level:02d}_{i}"), level + 1)
+    fill(os.path.join(root, "deep"), 1)  # ftp_backup salva le cartelle della radice, non i suoi file
+
+
+def make_wide_tree(root, dirs, files_per_dir, size):
+    """Albero largo: `dirs` cartelle sorelle sotto la radice, con pochi file ciascuna. Molti MLSD brevi."""
+    make_flat_tree(root, dirs * files_per_dir, size, files_per_dir)
+
+
+# Forme degli alberi sintetici dei benchmark: (descrizione, generatore(root, scale))
+TREE_SHAPES = {
+    'tiny': ("molti file minuscoli", lambda root, scale: make_flat_tree(root, int(20000 * scale), 1024)),
+    'huge': ("pochi file enormi", lambda root, scale: make_flat_tree(root, 4, int(256 * 1024 * 1024 * scale))),
+    'deep': ("cartelle annidate", lambda root, scale: make_deep_tree(root, 9, 2, max(1, int(8 * scale)), 8192)),
+    'wide': ("cartelle larghe", lambda root, scale: make_wide_tree(root, int(2000 * scale), 5, 16384)),
+}
+
+
+def make_tree(root, shape, scale=1.0):
+    """Genera in `root` un albero della forma `shape` (chiave di TREE_SHAPES), ridimensionato da `scale`."""
+    TREE_SHAPES[shape][1](root, scale)
+
+
+def list_local_tree(root, remote_prefix=""):
+    """Elenco [(remote, relativo, size, modify)] dei file sotto `root`, senza passare dal server."""
+    items = []
+    for dirpath, _, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        rel_dir = "" if rel_dir == "." else rel_dir
+        for name in filenames:
+            rel = f"{rel_dir}/{name}" if rel_dir else name
+            items.append((f"{remote_prefix}/{rel}", rel, os.path.getsize(os.path.join(dirpath, name)), ""))
+    return items
+
+
+def temp_dir(prefix):
+    return tempfile.mkdtemp(prefix=f"ftp_bench_{prefix}_")
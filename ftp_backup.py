@@ -1,26 +1,92 @@
+import argparse
+import asyncio
+import bisect
+import fnmatch
 import ftplib
 import os
 import sys
 import threading
 import time
-import itertools
 import getpass
-from datetime import datetime
+from collections import defaultdict, deque
+from datetime import datetime, timezone
 from queue import Queue
 from tqdm import tqdm
 import json
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import tempfile
+import gzip
+import hashlib
+import tarfile
+import uuid
+import warnings
+import zipfile
+import zlib
 
 # Import per la crittografia
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
 import base64
 
+try:
+    import zstandard  # Opzionale: serve solo per l'uscita tar.zst
+except ImportError:
+    zstandard = None
+try:
+    import fcntl  # Solo POSIX: senza, il prune si affida al solo controllo degli snapshot .partial
+except ImportError:
+    fcntl = None
+
 ### --- CONFIGURAZIONE --- ###
 BACKUP_FOLDER_PREFIX = "backup"
 ENCRYPTED_CREDS_FILE = "credentials.enc"
 PLAINTEXT_CREDS_FILE = "credentials.json"
+DISCOVERY_CONNECTIONS = 4  # Connessioni dedicate alla scansione parallela delle cartelle
+DEFAULT_WORKERS = 15  # Operai (connessioni di download) se non specificato
+PASSWORD_ENV_VAR = "FTP_BACKUP_PASSWORD"  # Password FTP per le esecuzioni non interattive
+MASTER_PASSWORD_ENV_VAR = "FTP_BACKUP_MASTER_PASSWORD"  # Master Password per usare credentials.enc senza prompt
+MANIFEST_DB_FILE = "manifest.db"  # Indice dei file già salvati, usato per i backup incrementali
+MANIFEST_BUSY_TIMEOUT = 60  # Secondi di attesa se un altro processo sta scrivendo nell'indice
+INCREMENTAL_BACKUP = True  # Scarica solo i file nuovi o modificati rispetto all'ultimo backup
+SCHEDULER_ADAPT_INTERVAL = 5.0  # Secondi tra due adattamenti del numero di operai attivi
+SMALL_FILE_THRESHOLD = 64 * 1024  # I file fino a questa dimensione usano il percorso veloce a lotti
+SMALL_FILE_BATCH = 64  # Quanti file piccoli un operaio preleva in un colpo solo
+TRANSFER_BLOCKSIZE = 1024 * 1024  # Buffer di ricezione/scrittura per i file grandi (byte)
+PROGRESS_INTERVAL = 0.25  # Secondi minimi tra due aggiornamenti della barra da parte di un trasferimento
+JOURNAL_CHECKPOINT_BYTES = 64 * 1024 * 1024  # Ogni quanti byte scritti un file grande registra il punto di ripresa
+MAX_CONNECT_FAILURES = 5  # Tentativi di connessione consecutivi (con backoff) prima di arrendersi
+POOL_KEEPALIVE_INTERVAL = 30  # Secondi di inattività dopo cui una sessione nel pool riceve un NOOP
+MAX_FILE_RETRIES = 3  # Nuovi tentativi, su un'altra sessione, per un file o una cartella la cui connessione è caduta
+JOURNAL_FILE = ".backup_journal.jsonl"  # Registro dei file completati, per riprendere un backup interrotto
+ARCHIVE_FORMATS = ('tar', 'tar.gz', 'tar.zst', 'zip')  # Uscita in archivio (--format) invece dell'albero di cartelle
+OUTPUT_FORMATS = ('dir',) + ARCHIVE_FORMATS + ('store',)  # 'store' = blob deduplicati per contenuto + snapshot
+ARCHIVE_COMPRESSION_LEVEL = 3  # Livello di compressione di gzip/zip/zstd: veloce, adatto allo streaming
+ARCHIVE_CHUNK_SIZE = 1024 * 1024  # Blocchi cifrati indipendenti (AES-GCM) degli archivi .enc
+ARCHIVE_PASSWORD_ENV_VAR = "FTP_BACKUP_ARCHIVE_PASSWORD"  # Password degli archivi cifrati (altrimenti la Master Password)
+VERIFY_HASH = 'sha256'  # Hash calcolato in ricezione se il server non ne offre uno da confrontare
+VERIFY_REPORT_FILE = ".backup_verify.jsonl"  # Rapporto di verifica dell'esecuzione, nella cartella del backup
+VERIFY_REPORT_SUFFIX = ".verify.jsonl"  # Con lo store il rapporto sta accanto allo snapshot
+SERVER_HASH_ALGORITHMS = {'SHA-256': 'sha256', 'SHA-512': 'sha512', 'SHA-1': 'sha1', 'MD5': 'md5', 'CRC32': 'crc32'}  # Nomi usati da HASH
+SERVER_HASH_COMMANDS = (('XSHA256', 'sha256'), ('XSHA512', 'sha512'), ('XSHA1', 'sha1'), ('XMD5', 'md5'), ('XCRC', 'crc32'))  # In ordine di preferenza
+STORE_DIR = "store"  # --format store: blob deduplicati e snapshot, nella cartella di output
+SNAPSHOT_SUFFIX = ".jsonl.gz"  # Elenco compresso di percorsi e hash di uno snapshot
+STORE_LOCK_FILE = "store.lock"  # Lock dello store: condiviso da backup e ripristini, esclusivo per il prune
+STORE_PARTIAL_GRACE = 24 * 3600  # Secondi: un prune rifiuta di partire se uno snapshot in scrittura è più recente
+LIMITS_CHECK_INTERVAL = 2.0  # Secondi tra due controlli del file dei limiti per host (--limits)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Secondi: login e MLSD (istogrammi)
+FILE_SIZE_BUCKETS = (1024, 16 * 1024, 64 * 1024, 1024 ** 2, 16 * 1024 ** 2, 128 * 1024 ** 2, 1024 ** 3)  # Byte
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)  # Byte/s
+INVENTORY_CHUNK_SIZE = 64 * 1024  # Byte: blocchi di record compatti dei file in attesa (FileInventory)
+INVENTORY_MEMORY_LIMIT = 256 * 1024 ** 2  # Byte di file in attesa tenuti in memoria; oltre si scrivono su disco
+MAX_TOTAL_CONNECTIONS = 30  # Backup multi-sito (--sites): connessioni FTP contemporanee in tutto il processo
 ####################################
 
 STRINGS = {
@@ -40,21 +106,61 @@ STRINGS = {
         'PROMPT_CREATE_MASTER_PASS': "Crea una Master Password per proteggere il file: ",
         'PROMPT_CONFIRM_MASTER_PASS': "Conferma la Master Password: ",
         'PROMPT_CONFIRM_PLAINTEXT': "ATTENZIONE! Stai per salvare la password in un file leggibile. Sei sicuro? (s/n): ",
+        'PROMPT_ARCHIVE_PASS': "Password dell'archivio: ",
         'STATUS_CONNECTING': "\n🔌 Connessione a {host}...",
         'OK_CONNECTED': "✅ Connessione FTP stabilita con successo.",
         'STATUS_SCANNING': "🔎 Scansione delle cartelle remote in corso...",
         'OK_SCAN_COMPLETE': "👍 Scansione completata.",
-        'STATUS_DISCOVERING': " Analizzando file remoti (potrebbe volerci un po')... ",
+        'STATUS_DISCOVERY_DOWNLOAD': "\nAnalisi e download dei file in corso ({listers} connessioni di scansione)...",
+        'STATUS_ENGINE': "⚙️  Motore di download: {engine} ({workers} connessioni)",
+        'STATUS_VERIFY_SERVER': "🔐 Verifica: hash {algorithm} calcolato in ricezione e confrontato con quello del server ({command}).",
+        'STATUS_VERIFY_LOCAL': "🔐 Verifica: il server non fornisce hash, dimensioni controllate e hash {algorithm} registrato nel rapporto.",
+        'STATUS_SITES': "\n🌐 Backup di {count} siti in parallelo (massimo {connections} connessioni in totale)...",
         'LBL_AVAILABLE_DIRS': "\n--- Cartelle disponibili per il backup ---",
         'LBL_FILES_FOUND': "Trovati {count} file da scaricare.",
         'LBL_DOWNLOAD_START': "\nDownload dei file in corso...",
         'LBL_BACKUP_COMPLETE': "\n🎉 Backup completato!",
         'LBL_FILES_SAVED_TO': "I file sono stati salvati in: {path}",
         'LBL_DISCOVERY_SUMMARY': "Analisi completata: Trovati {file_count} file in {dir_count} cartelle.",
+        'LBL_INCREMENTAL_SUMMARY': "♻️  {count} file invariati ({size}) ripresi dal backup precedente senza riscaricarli.",
+        'LBL_RESUMING': "\n⏯️  Ripresa del backup interrotto in: {path}",
+        'LBL_RESUME_SUMMARY': "⏯️  {count} file già completati nell'esecuzione interrotta, verranno saltati.",
+        'LBL_FAILED_SUMMARY': "⚠️  {count} file non scaricati (vedi gli errori sopra).",
+        'LBL_CONNECTION_SUMMARY': "🔌 Connessioni: {logins} login, {reused} sessioni riutilizzate, {dropped} cadute, {retried} nuovi tentativi.",
+        'LBL_ARCHIVE_SEGMENTS': "📦 Archivio in {count} segmenti ({format}).",
+        'LBL_STORE_SUMMARY': "🧩 Store: {new} contenuti nuovi ({new_size}), {dedup} già presenti ({dedup_size} non duplicati).",
+        'LBL_VERIFY_SUMMARY': "🔐 Verificati {verified} file ({server} con l'hash del server), {mismatches} discrepanze riscaricate. Rapporto: {path}",
+        'LBL_LIMITS_RELOADED': "🎚️  Limiti per host ricaricati da {path}.",
+        'LBL_METRICS_SUMMARY': "⏱️  Tempi: scansione {discovery:.1f}s, download {download:.1f}s, totale {total:.1f}s; login medio {connect:.0f} ms, MLSD medio {mlsd:.0f} ms (max {mlsd_max:.0f} ms), {throughput}/s.",
+        'LBL_WORKERS_ADJUSTED': "    ⚙️  Operai attivi: {active}/{total} ({reason})",
+        'LBL_REASON_SERVER_ERRORS': "errori dal server",
+        'LBL_REASON_THROUGHPUT': "velocità in aumento",
+        'LBL_SITE_DONE': "✅ [{name}] {files} file ({size}), {failed} non scaricati -> {path}",
+        'LBL_SITE_FAILED': "[{name}] {e}",
+        'LBL_SITES_SUMMARY': "\n🎉 {ok}/{total} siti salvati in {elapsed:.0f}s.",
         'OK_DECRYPT': "Credenziali decriptate con successo!",
         'OK_SAVE': "Credenziali salvate e criptate con successo!",
         'OK_SAVE_PLAIN': "Credenziali salvate in chiaro nel file '{filename}'.",
+        'OK_ARCHIVE_DECRYPTED': "🔓 Archivio decifrato in: {path}",
+        'OK_RESTORED': "📂 Ripristinati {files} file ({size}) in: {path}",
+        'OK_PRUNED': "🧹 Rimossi {snapshots} snapshot e {blobs} contenuti non più usati ({size} liberati).",
         'ERR_CONNECTION': "❌ Errore di connessione: {e}",
+        'ERR_CONNECTION_FAILED': "❌ Impossibile connettersi a {host}.",
+        'ERR_MISSING_HOST': "❌ Host o utente FTP mancanti (--host/--user, file di configurazione o credenziali salvate).",
+        'ERR_NO_PASSWORD': "❌ Password FTP mancante: usa la variabile d'ambiente {env}, --password-file oppure le credenziali criptate con {master_env}.",
+        'ERR_CONFIG_FILE': "❌ File di configurazione non valido '{path}': {e}",
+        'ERR_NO_SITES': "❌ Nessun sito nel file '{path}' (chiave \"sites\").",
+        'ERR_ARCHIVE_FORMAT': "❌ Formato di uscita '{format}' non valido (ammessi: {formats}).",
+        'ERR_INVALID_RATE': "❌ Valore non valido per {option}: '{value}' (es. 512K, 10M, 1.5G o un numero).",
+        'ERR_ZSTD_MISSING': "❌ Per il formato tar.zst serve il pacchetto 'zstandard' (pip install zstandard).",
+        'ERR_ARCHIVE_ENGINE': "❌ L'uscita in archivio è disponibile solo con il motore 'threads'.",
+        'ERR_ARCHIVE_RESUME': "❌ Un backup in archivio non si può riprendere: avvia un nuovo backup.",
+        'ERR_ENCRYPT_NEEDS_ARCHIVE': "❌ La cifratura richiede un formato d'archivio tar o zip (--format).",
+        'ERR_NO_ARCHIVE_PASSWORD': "❌ Password dell'archivio mancante: usa la variabile d'ambiente {env} (o {master_env}).",
+        'ERR_DECRYPT_ARCHIVE': "❌ Impossibile decifrare '{path}': {e}",
+        'ERR_RESTORE': "❌ Ripristino di '{path}' fallito: {e}",
+        'ERR_STORE_BUSY': "❌ Un backup o un ripristino sta usando lo store ({path}): riprova quando ha finito.",
+        'ERR_PRUNE_POLICY': "❌ Indica almeno --keep-last o --keep-days.",
         'ERR_SCAN_FAILED': "❌ Scansione cartelle fallita: {e}.",
         'ERR_NO_DIRS_FOUND': "Nessuna cartella trovata sul server o errore durante la scansione.",
         'ERR_INVALID_INPUT': "❌ Input non valido.",
@@ -64,6 +170,14 @@ STRINGS = {
         'ERR_PASS_MISMATCH': "Le password non coincidono. Riprova.",
         'ERR_EXPLORE_DIR': "⚠️ Impossibile esplorare {path}: {e}",
         'ERR_DOWNLOAD_FILE': "    ⚠️ Errore download '{filename}': {e}",
+        'ERR_SIZE_CHANGED': "dimensione diversa da quella sul server ({expected} byte attesi, {actual} ricevuti)",
+        'ERR_HASH_MISMATCH': "l'hash {algorithm} non corrisponde a quello del server",
+        'ERR_LIMITS_RELOAD': "⚠️  Impossibile ricaricare i limiti da '{path}': {e}. Restano in vigore quelli precedenti.",
+        'ERR_NO_CONNECTION': "nessuna connessione disponibile con il server",
+        'ERR_MANIFEST': "    ⚠️ Indice dei backup non disponibile, eseguo un backup completo: {e}",
+        'ERR_RECORD_BATCH': "    ⚠️ Impossibile registrare {count} file scaricati nell'indice o nel registro (saranno riscaricati): {e}",
+        'ERR_RESUME_NO_JOURNAL': "❌ Nessun registro di backup trovato in '{path}': impossibile riprendere.",
+        'ERR_RESUME_HOST_MISMATCH': "❌ Il backup da riprendere appartiene a {expected}, non a {actual}.",
         'ERR_SYSTEM_SAVE': "    ⚠️ Errore di Sistema durante il salvataggio di '{filename}': {e}",
         'CHOICE_ALL': "tutto",
         'CHOICE_YES': 's',
@@ -73,6 +187,7 @@ STRINGS = {
         'BACKUP_PART_FULL': "full-backup",
         'BACKUP_PART_MULTI': "multiple-dirs",
         'TQDM_TOTAL_BACKUP': "Backup Totale",
+        'TQDM_TOTAL_DISCOVERING': "Backup Totale (analisi in corso)",
         'TQDM_FILE': "  -> {filename:<40}"
     },
     'en': {
@@ -91,21 +206,61 @@ STRINGS = {
         'PROMPT_CREATE_MASTER_PASS': "Create a Master Password to protect the file: ",
         'PROMPT_CONFIRM_MASTER_PASS': "Confirm the Master Password: ",
         'PROMPT_CONFIRM_PLAINTEXT': "WARNING! You are about to save your password in a readable file. Are you sure? (y/n): ",
+        'PROMPT_ARCHIVE_PASS': "Archive password: ",
         'STATUS_CONNECTING': "\n🔌 Connecting to {host}...",
         'OK_CONNECTED': "✅ FTP connection established successfully.",
         'STATUS_SCANNING': "🔎 Scanning remote folders...",
         'OK_SCAN_COMPLETE': "👍 Scan complete.",
-        'STATUS_DISCOVERING': " Analyzing remote files (this may take a while)... ",
+        'STATUS_DISCOVERY_DOWNLOAD': "\nAnalyzing and downloading files ({listers} scanning connections)...",
+        'STATUS_ENGINE': "⚙️  Download engine: {engine} ({workers} connections)",
+        'STATUS_VERIFY_SERVER': "🔐 Verification: {algorithm} hash computed while receiving and compared with the server's ({command}).",
+        'STATUS_VERIFY_LOCAL': "🔐 Verification: the server offers no hashes; sizes are checked and the {algorithm} hash is recorded in the report.",
+        'STATUS_SITES': "\n🌐 Backing up {count} sites in parallel (at most {connections} connections in total)...",
         'LBL_AVAILABLE_DIRS': "\n--- Available folders for backup ---",
         'LBL_FILES_FOUND': "Found {count} files to download.",
         'LBL_DOWNLOAD_START': "\nDownloading files...",
         'LBL_BACKUP_COMPLETE': "\n🎉 Backup complete!",
         'LBL_FILES_SAVED_TO': "Files have been saved to: {path}",
         'LBL_DISCOVERY_SUMMARY': "Analysis complete: Found {file_count} files in {dir_count} folders.",
+        'LBL_INCREMENTAL_SUMMARY': "♻️  {count} unchanged files ({size}) reused from the previous backup without downloading.",
+        'LBL_RESUMING': "\n⏯️  Resuming interrupted backup in: {path}",
+        'LBL_RESUME_SUMMARY': "⏯️  {count} files already completed by the interrupted run will be skipped.",
+        'LBL_FAILED_SUMMARY': "⚠️  {count} files could not be downloaded (see errors above).",
+        'LBL_CONNECTION_SUMMARY': "🔌 Connections: {logins} logins, {reused} sessions reused, {dropped} dropped, {retried} retries.",
+        'LBL_ARCHIVE_SEGMENTS': "📦 Archive written as {count} segments ({format}).",
+        'LBL_STORE_SUMMARY': "🧩 Store: {new} new blobs ({new_size}), {dedup} already stored ({dedup_size} deduplicated).",
+        'LBL_VERIFY_SUMMARY': "🔐 Verified {verified} files ({server} against the server hash), {mismatches} mismatches re-downloaded. Report: {path}",
+        'LBL_LIMITS_RELOADED': "🎚️  Per-host limits reloaded from {path}.",
+        'LBL_METRICS_SUMMARY': "⏱️  Timings: discovery {discovery:.1f}s, download {download:.1f}s, total {total:.1f}s; mean login {connect:.0f} ms, mean MLSD {mlsd:.0f} ms (max {mlsd_max:.0f} ms), {throughput}/s.",
+        'LBL_WORKERS_ADJUSTED': "    ⚙️  Active workers: {active}/{total} ({reason})",
+        'LBL_REASON_SERVER_ERRORS': "server errors",
+        'LBL_REASON_THROUGHPUT': "throughput improving",
+        'LBL_SITE_DONE': "✅ [{name}] {files} files ({size}), {failed} failed -> {path}",
+        'LBL_SITE_FAILED': "[{name}] {e}",
+        'LBL_SITES_SUMMARY': "\n🎉 {ok}/{total} sites backed up in {elapsed:.0f}s.",
         'OK_DECRYPT': "Credentials decrypted successfully!",
         'OK_SAVE': "Credentials saved and encrypted successfully!",
         'OK_SAVE_PLAIN': "Credentials saved in plaintext to '{filename}'.",
+        'OK_ARCHIVE_DECRYPTED': "🔓 Archive decrypted to: {path}",
+        'OK_RESTORED': "📂 Restored {files} files ({size}) to: {path}",
+        'OK_PRUNED': "🧹 Removed {snapshots} snapshots and {blobs} unreferenced blobs ({size} freed).",
         'ERR_CONNECTION': "❌ Connection error: {e}",
+        'ERR_CONNECTION_FAILED': "❌ Could not connect to {host}.",
+        'ERR_MISSING_HOST': "❌ Missing FTP host or user (--host/--user, config file or saved credentials).",
+        'ERR_NO_PASSWORD': "❌ Missing FTP password: use the {env} environment variable, --password-file or the encrypted credentials with {master_env}.",
+        'ERR_CONFIG_FILE': "❌ Invalid config file '{path}': {e}",
+        'ERR_NO_SITES': "❌ No sites in '{path}' (\"sites\" key).",
+        'ERR_ARCHIVE_FORMAT': "❌ Invalid output format '{format}' (allowed: {formats}).",
+        'ERR_INVALID_RATE': "❌ Invalid value for {option}: '{value}' (e.g. 512K, 10M, 1.5G or a number).",
+        'ERR_ZSTD_MISSING': "❌ The tar.zst format needs the 'zstandard' package (pip install zstandard).",
+        'ERR_ARCHIVE_ENGINE': "❌ Archive output is only available with the 'threads' engine.",
+        'ERR_ARCHIVE_RESUME': "❌ An archive backup cannot be resumed: start a new backup.",
+        'ERR_ENCRYPT_NEEDS_ARCHIVE': "❌ Encryption requires a tar or zip archive format (--format).",
+        'ERR_NO_ARCHIVE_PASSWORD': "❌ Missing archive password: set the {env} environment variable (or {master_env}).",
+        'ERR_DECRYPT_ARCHIVE': "❌ Could not decrypt '{path}': {e}",
+        'ERR_RESTORE': "❌ Restoring '{path}' failed: {e}",
+        'ERR_STORE_BUSY': "❌ A backup or restore is using the store ({path}): try again once it has finished.",
+        'ERR_PRUNE_POLICY': "❌ Specify at least --keep-last or --keep-days.",
         'ERR_SCAN_FAILED': "❌ Folder scan failed: {e}.",
         'ERR_NO_DIRS_FOUND': "No folders found on server or scan error.",
         'ERR_INVALID_INPUT': "❌ Invalid input.",
@@ -115,6 +270,14 @@ STRINGS = {
         'ERR_PASS_MISMATCH': "Passwords do not match. Please try again.",
         'ERR_EXPLORE_DIR': "⚠️ Could not explore {path}: {e}",
         'ERR_DOWNLOAD_FILE': "    ⚠️ Error downloading '{filename}': {e}",
+        'ERR_SIZE_CHANGED': "size differs from the server ({expected} bytes expected, {actual} received)",
+        'ERR_HASH_MISMATCH': "{algorithm} hash does not match the server's",
+        'ERR_LIMITS_RELOAD': "⚠️  Could not reload the limits from '{path}': {e}. The previous limits stay in force.",
+        'ERR_NO_CONNECTION': "no connection to the server available",
+        'ERR_MANIFEST': "    ⚠️ Backup index unavailable, running a full backup: {e}",
+        'ERR_RECORD_BATCH': "    ⚠️ Could not record {count} downloaded files in the index or journal (they will be downloaded again): {e}",
+        'ERR_RESUME_NO_JOURNAL': "❌ No backup journal found in '{path}': cannot resume.",
+        'ERR_RESUME_HOST_MISMATCH': "❌ The backup to resume belongs to {expected}, not {actual}.",
         'ERR_SYSTEM_SAVE': "    ⚠️ System Error while saving '{filename}': {e}",
         'CHOICE_ALL': "all",
         'CHOICE_YES': 'y',
@@ -124,12 +287,14 @@ STRINGS = {
         'BACKUP_PART_FULL': "full-backup",
         'BACKUP_PART_MULTI': "multiple-dirs",
         'TQDM_TOTAL_BACKUP': "Total Backup",
+        'TQDM_TOTAL_DISCOVERING': "Total Backup (analyzing)",
         'TQDM_FILE': "  -> {filename:<40}"
     }
 }
 ####################################
 
 tqdm_lock = threading.Lock()
+transfer_buffers = threading.local()  # Un buffer di ricezione per thread, riusato da un file all'altro
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 class Colors:
@@ -166,10 +331,10 @@ class CredentialsManager:
             return json.loads(decrypted_data)
         except Exception: return None
 
-def connect_ftp(host, user, password, t):
+def connect_ftp(host, user, password, t, port=21):
     try:
         ftp = ftplib.FTP(timeout=60)
-        ftp.connect(host)
+        ftp.connect(host, port)
         ftp.login(user, password)
         ftp.set_pasv(True)
         return ftp
@@ -177,102 +342,2765 @@ def connect_ftp(host, user, password, t):
         with tqdm_lock: tqdm.write(t['ERR_CONNECTION'].format(e=e))
         return None
 
-def get_remote_dirs(ftp, t):
-    print(t['STATUS_SCANNING'])
+def get_remote_dirs(ftp, t, say=print):
+    """Cartelle nella radice del server. `say` stampa i messaggi di avanzamento (gli errori si vedono sempre)."""
+    say(t['STATUS_SCANNING'])
     remote_dirs = []
     try:
         items = ftp.mlsd()
         for name, facts in items:
             if facts.get('type') == 'dir' and name not in ['.', '..']:
                 remote_dirs.append(name)
-        print(t['OK_SCAN_COMPLETE'])
+        say(t['OK_SCAN_COMPLETE'])
         return remote_dirs
     except Exception as e:
         print(t['ERR_SCAN_FAILED'].format(e=e))
         return []
-def create_loading_bar_frames(width=10, char="■"):
-    """Genera i fotogrammi per un'animazione a barra di caricamento."""
-    frames = []
-    for i in range(width + 1):
-        bar = char * i
-        padding = " " * (width - i)
-        frames.append(f"[{bar}{padding}]")
-    for i in range(width + 1):
-        bar = char * (width - i)
-        padding = " " * i
-        frames.append(f"[{padding}{bar}]")
-    return frames
-
-def animate_discovery(stop_event, t):
-    """Mostra un'animazione a barra di caricamento."""
-    # Creiamo la sequenza di fotogrammi una sola volta
-    loading_bar_frames = create_loading_bar_frames()
-    spinner = itertools.cycle(loading_bar_frames)
-    
-    while not stop_event.is_set():
+class ManifestIndex:
+    """Indice SQLite dei file salvati nei backup precedenti (percorso, dimensione, data di
+    modifica e copia locale), usato per scaricare solo i file nuovi o modificati."""
+    COMMIT_EVERY = 500
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.pending = 0
+        # Attesa lunga sul lock: lo stesso indice può essere aperto anche da un'altra esecuzione
+        self.conn = sqlite3.connect(filepath, timeout=MANIFEST_BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+            site TEXT NOT NULL, remote_path TEXT NOT NULL, size INTEGER NOT NULL,
+            modify TEXT NOT NULL, local_path TEXT NOT NULL, PRIMARY KEY (site, remote_path))""")
+        self.conn.commit()
+
+    def lookup(self, site, remote_path):
+        with self.lock:
+            return self.conn.execute("SELECT size, modify, local_path FROM files WHERE site = ? AND remote_path = ?",
+                                     (site, remote_path)).fetchone()
+
+    def record(self, site, remote_path, size, modify, local_path):
+        self.record_many([(site, remote_path, size, modify, local_path)])
+
+    def record_many(self, rows):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", rows)
+            self.pending += len(rows)
+            if self.pending >= self.COMMIT_EVERY:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class RunJournal:
+    """Registro append-only (JSON lines) di un'esecuzione: intestazione con i parametri del backup,
+    file iniziati (con dimensione e data di MLSD), punti di ripresa dei file grandi e file completati.
+    Sopravvive a un crash e permette di riprendere con --resume: solo allora (`resume=True`) il
+    registro esistente viene riletto."""
+    FSYNC_EVERY = 100
+
+    def __init__(self, filepath, resume=False):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.header = None
+        self.done = set()
+        self.begun = {}  # remote_path -> (size, modify) del file che si stava scrivendo
+        self.progress = {}
+        self.unsynced = 0
+        if resume and os.path.exists(filepath): self._replay()
+        self.f = open(filepath, 'a', encoding='utf-8')
+        # Un crash può aver lasciato a metà l'ultima riga: la chiudiamo prima di accodare
+        if self.f.tell() > 0:
+            with open(filepath, 'rb') as check:
+                check.seek(-1, os.SEEK_END)
+                if check.read(1) != b'\n': self.f.write('\n')
+
+    def _replay(self):
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: record = json.loads(line)
+                except ValueError: continue
+                if record.get('op') == 'run' and self.header is None: self.header = record
+                elif record.get('op') == 'begin':
+                    self.begun[record['remote']] = (record.get('size'), record.get('modify'))
+                    self.progress.pop(record['remote'], None)
+                elif record.get('op') == 'progress': self.progress[record['remote']] = record['bytes']
+                elif record.get('op') == 'done':
+                    self.done.add(record['remote'])
+                    self.begun.pop(record['remote'], None)
+                    self.progress.pop(record['remote'], None)
+
+    def write(self, record):
+        self.write_many([record])
+
+    def write_many(self, records):
+        with self.lock:
+            self.f.write(''.join(json.dumps(record) + '\n' for record in records))
+            self.f.flush()
+            self.unsynced += len(records)
+            if self.unsynced >= self.FSYNC_EVERY:
+                os.fsync(self.f.fileno())
+                self.unsynced = 0
+
+    def begin(self, remote_path, size, modify, offset):
+        with self.lock:
+            self.begun[remote_path] = (size, modify)
+            self.progress.pop(remote_path, None)
+        self.write({'op': 'begin', 'remote': remote_path, 'size': size, 'modify': modify, 'offset': offset})
+
+    def checkpoint(self, remote_path, written):
+        """Byte già scritti su disco: i file preallocati hanno subito la dimensione finale, quindi
+        il punto di ripresa non si può ricavare dalla dimensione del file locale."""
+        with self.lock: self.progress[remote_path] = written
+        self.write({'op': 'progress', 'remote': remote_path, 'bytes': written})
+
+    def resume_offset(self, remote_path, local_file_path, size, modify):
+        """Offset da cui riprendere (REST) un file lasciato a metà da un'esecuzione interrotta. Si
+        riparte da zero se il file locale non è stato iniziato da questo registro (potrebbe essere un
+        collegamento al backup precedente) o se dimensione o data remote sono cambiate nel frattempo:
+        i byte su disco sarebbero di un altro file."""
+        with self.lock: begun, written = self.begun.get(remote_path), self.progress.get(remote_path)
+        if begun != (size, modify) or not os.path.isfile(local_file_path): return 0
+        on_disk = os.path.getsize(local_file_path)
+        offset = min(written, on_disk) if written is not None else on_disk
+        return offset if 0 < offset and (size is None or offset < size) else 0
+
+    # `done` contiene solo i file dell'esecuzione ripresa: quelli completati ora non vengono più
+    # rielencati, e tenerli in memoria costerebbe un percorso completo per file
+    def mark_done(self, remote_path, size):
+        with self.lock:
+            self.begun.pop(remote_path, None)
+            self.progress.pop(remote_path, None)
+        self.write({'op': 'done', 'remote': remote_path, 'size': size})
+
+    def mark_done_many(self, files):
+        """Registra in una sola scrittura un lotto di file completati [(remote_path, size), ...]."""
+        self.write_many([{'op': 'done', 'remote': remote_path, 'size': size} for remote_path, size in files])
+
+    def is_done(self, remote_path):
+        with self.lock: return remote_path in self.done
+
+    def close(self):
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+
+class IntegrityError(ValueError):
+    """Il file ricevuto non corrisponde a quello remoto (dimensione o hash): va riscaricato."""
+
+class Crc32:
+    """CRC32 (XCRC, HASH CRC32) con la stessa interfaccia degli oggetti di hashlib."""
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+def new_hasher(algorithm):
+    return Crc32() if algorithm == 'crc32' else hashlib.new(algorithm)
+
+def detect_server_hash(ftp):
+    """Comando per chiedere al server l'hash di un file, dalle estensioni annunciate in FEAT: HASH
+    (con l'algoritmo selezionato, marcato da '*') oppure XSHA256/XSHA512/XSHA1/XMD5/XCRC.
+    Ritorna (comando, algoritmo), oppure (None, VERIFY_HASH) se il server non ne offre."""
+    try:
+        features = ftp.sendcmd('FEAT')
+    except ftplib.all_errors:
+        return None, VERIFY_HASH
+    facts = {}
+    for line in features.splitlines()[1:-1]:
+        parts = line.strip().split(None, 1)
+        if parts: facts[parts[0].upper()] = parts[1] if len(parts) > 1 else ''
+    for algorithm in facts.get('HASH', '').split(';'):
+        if algorithm.endswith('*') and algorithm[:-1].upper() in SERVER_HASH_ALGORITHMS:
+            return 'HASH', SERVER_HASH_ALGORITHMS[algorithm[:-1].upper()]
+    for command, algorithm in SERVER_HASH_COMMANDS:
+        if command in facts: return command, algorithm
+    return None, VERIFY_HASH
+
+class VerificationReport:
+    """Rapporto di verifica di un'esecuzione (JSON lines): per ogni file scaricato l'hash calcolato
+    durante la ricezione e l'esito del confronto con quello del server, le discrepanze (il file
+    viene riscaricato), i file falliti e un riepilogo finale."""
+    def __init__(self, filepath, site, command, algorithm):
+        self.filepath = filepath
+        self.command, self.algorithm = command, algorithm
+        self.digest_length = len(new_hasher(algorithm).hexdigest())
+        self.lock = threading.Lock()
+        self.verified = self.server_verified = self.mismatches = 0
+        self.f = open(filepath, 'a', encoding='utf-8')
+        self.write({'op': 'run', 'site': site, 'algorithm': algorithm, 'server_hash': command,
+                    'started': datetime.now().isoformat(timespec='seconds')})
+
+    def write(self, record):
+        with self.lock: self.f.write(json.dumps(record) + '\n')
+
+    def new_hasher(self):
+        return new_hasher(self.algorithm)
+
+    def server_command(self, remote_path):
+        return f"{self.command} {remote_path}" if self.command else None
+
+    def parse_digest(self, resp):
+        """L'hash nella risposta del server: il primo campo esadecimale della lunghezza attesa
+        (HASH risponde 'algoritmo intervallo hash nome', XMD5 e simili di solito solo l'hash)."""
+        for field in resp.split()[1:]:
+            if len(field) == self.digest_length and all(c in '0123456789abcdefABCDEF' for c in field): return field.lower()
+        return None
+
+    def mismatch(self, remote_path, check, expected, actual):
+        with self.lock: self.mismatches += 1
+        self.write({'op': 'mismatch', 'remote': remote_path, 'check': check, 'expected': expected, 'actual': actual})
+
+    def check(self, remote_path, size, hasher, server_digest, t):
+        """Confronta l'hash calcolato in ricezione con quello del server, se disponibile; solleva
+        IntegrityError se non coincidono."""
+        digest = hasher.hexdigest()
+        if server_digest and server_digest != digest:
+            self.mismatch(remote_path, self.algorithm, server_digest, digest)
+            raise IntegrityError(t['ERR_HASH_MISMATCH'].format(algorithm=self.algorithm))
+        with self.lock:
+            self.verified += 1
+            if server_digest: self.server_verified += 1
+        self.write({'op': 'ok', 'remote': remote_path, 'size': size, self.algorithm: digest, 'server': bool(server_digest)})
+
+    def failed(self, remote_path, e):
+        self.write({'op': 'failed', 'remote': remote_path, 'error': str(e)})
+
+    def close(self):
+        self.write({'op': 'summary', 'verified': self.verified, 'server_verified': self.server_verified,
+                    'mismatches': self.mismatches, 'finished': datetime.now().isoformat(timespec='seconds')})
+        with self.lock: self.f.close()
+
+def link_or_copy(src, dst):
+    """Collega (hard link) un file del backup precedente nel nuovo backup, copiandolo se il link non è possibile."""
+    try: os.link(src, dst)
+    except OSError: shutil.copy2(src, dst)
+
+class DiscoveryStats:
+    """Contatori condivisi tra gli operai di scansione (protetti da lock)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file_count = 0
+        self.dir_count = 0
+        self.total_size = 0
+        self.unchanged_count = 0
+        self.unchanged_size = 0
+        self.already_done_count = 0
+        self.failed_count = 0
+        self.retried_count = 0
+
+class TokenBucket:
+    """Secchiello di gettoni thread-safe: reserve(n) prenota n unità (byte, comandi, ...) e restituisce
+    quanti secondi attendere per restare entro `rate` unità al secondo, con raffiche fino a `burst`.
+    Con `rate` None o 0 non limita nulla."""
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Nuova velocità, valida da subito anche per i trasferimenti già in corso."""
+        with self.lock:
+            self.rate = float(rate or 0)
+            self.burst = float(burst or rate or 0)
+            self.tokens = self.burst if self.tokens is None else min(self.tokens, self.burst)
+            self.last = time.monotonic()
+
+    def reserve(self, n):
+        with self.lock:
+            if not self.rate: return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+def parse_rate(value):
+    """'200M', '512K', '1G' o un numero -> byte al secondo (multipli di 1024)."""
+    if value is None or isinstance(value, (int, float)): return value
+    value = str(value).strip().upper().removesuffix('/S').rstrip('B')
+    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(value[-1:], 1)
+    return float(value[:-1] if multiplier > 1 else value) * multiplier
+
+class HostLimits:
+    """Limiti per host condivisi da tutti i siti e le sessioni del processo: byte/s (`max_bandwidth`)
+    e comandi/s (`max_commands`, cioè elenchi, download, hash e login), ciascuno un TokenBucket.
+    `limits` = {host: {...}, '*': {...}} ('*' vale per ogni host). Con `path` i limiti arrivano anche
+    da un file JSON con la stessa struttura, riletto quando cambia o quando il processo riceve
+    SIGHUP: i secchielli esistenti cambiano velocità sul posto, senza interrompere i trasferimenti.
+    Con `quiet` la rilettura riuscita non viene annunciata (gli errori sì)."""
+    def __init__(self, limits=None, path=None, t=None, quiet=False):
+        self.lock = threading.Lock()
+        self.static = limits or {}
+        self.path = path
+        self.t = t or STRINGS['en']
+        self.quiet = quiet
+        self.limits = self.static
+        self.buckets = {}  # host -> (secchiello byte/s, secchiello comandi/s)
+        self.mtime = None
+        self.next_check = 0.0
+        self.reload_requested = False
+        for host in self.static:
+            for key, value in self.static[host].items():
+                resolve_rate(value, f"host_limits['{host}'].{key}", self.t)
+        if path:
+            error = self.reload()
+            if error: raise BackupError(self.t['ERR_CONFIG_FILE'].format(path=path, e=error))
+
+    def rates(self, host, limits=None):
+        merged = {**(limits or self.limits).get('*', {}), **(limits or self.limits).get(host, {})}
+        return parse_rate(merged.get('max_bandwidth')), parse_rate(merged.get('max_commands'))
+
+    def buckets_for(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                byte_rate, command_rate = self.rates(host)
+                self.buckets[host] = (TokenBucket(byte_rate), TokenBucket(command_rate))
+            return self.buckets[host]
+
+    def request_reload(self, *_):
+        """Gestore di SIGHUP: segna solo la richiesta, la rilettura avviene al prossimo controllo."""
+        self.reload_requested = True
+
+    def maybe_reload(self):
+        """Controllo economico, chiamato a ogni blocco o comando: il file viene guardato al massimo
+        ogni LIMITS_CHECK_INTERVAL secondi e riletto solo se è cambiato (o dopo SIGHUP)."""
+        if not self.path: return
+        now = time.monotonic()
+        if not self.reload_requested and now < self.next_check: return
+        self.next_check = now + LIMITS_CHECK_INTERVAL
+        try: changed = os.path.getmtime(self.path) != self.mtime
+        except OSError: changed = False
+        if not (changed or self.reload_requested): return
+        error = self.reload()
+        if not error and self.quiet: return
+        with tqdm_lock:
+            if error: tqdm.write(self.t['ERR_LIMITS_RELOAD'].format(path=self.path, e=error))
+            else: tqdm.write(self.t['LBL_LIMITS_RELOADED'].format(path=self.path))
+
+    def reload(self):
+        """Rilegge il file; ritorna l'errore (lasciando in vigore i limiti precedenti) o None."""
+        self.reload_requested = False
+        try:
+            self.mtime = os.path.getmtime(self.path)
+            with open(self.path, 'r', encoding='utf-8') as f: loaded = json.load(f)
+            if not isinstance(loaded, dict) or not all(isinstance(v, dict) for v in loaded.values()):
+                raise ValueError("JSON object {host: {max_bandwidth, max_commands}} expected")
+            limits = {**self.static, **loaded}
+            for host in limits: self.rates(host, limits)  # Valori non validi: errore prima di applicare
+        except (OSError, ValueError) as e:
+            return e
+        with self.lock:
+            self.limits = limits
+            for host, (byte_bucket, command_bucket) in self.buckets.items():
+                byte_rate, command_rate = self.rates(host)
+                byte_bucket.set_rate(byte_rate)
+                command_bucket.set_rate(command_rate)
+        return None
+
+    def install_signal(self):
+        """SIGHUP ricarica il file dei limiti (solo nel thread principale e dove SIGHUP esiste).
+        Ritorna il gestore precedente, da ripristinare a fine esecuzione."""
+        if not self.path or not hasattr(signal, 'SIGHUP') or threading.current_thread() is not threading.main_thread():
+            return None
+        return signal.signal(signal.SIGHUP, self.request_reload)
+
+class ConnectionBudget:
+    """Tetto globale di connessioni FTP condiviso da più siti nello stesso processo, con un limite
+    per host e una quota equa per sito: un sito può superare la propria quota solo se nessun altro
+    sito sotto quota sta aspettando una connessione."""
+    def __init__(self, max_connections, max_per_host=None):
+        self.cond = threading.Condition()
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.used = 0
+        self.per_host = defaultdict(int)
+        self.per_site = defaultdict(int)
+        self.waiting = defaultdict(int)  # (sito, host) -> thread in attesa
+        self.sites = set()
+
+    def register(self, site):
+        with self.cond: self.sites.add(site)
+
+    def unregister(self, site):
+        """Sito finito: la sua quota viene ridistribuita agli altri."""
+        with self.cond:
+            self.sites.discard(site)
+            self.cond.notify_all()
+
+    def fair_share(self):
+        return max(1, self.max_connections // max(len(self.sites), 1))
+
+    def _host_has_room(self, host):
+        return not self.max_per_host or self.per_host[host] < self.max_per_host
+
+    def _others_starving(self, site, host):
+        # Altri siti sotto quota in attesa, che potrebbero usare la connessione liberata
+        share = self.fair_share()
+        return any(count and other != site and self.per_site[other] < share and (other_host == host or self._host_has_room(other_host))
+                   for (other, other_host), count in self.waiting.items())
+
+    def _can_grant(self, site, host):
+        if self.used >= self.max_connections or not self._host_has_room(host): return False
+        return self.per_site[site] < self.fair_share() or not self._others_starving(site, host)
+
+    def acquire(self, site, host, blocking=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            self.waiting[(site, host)] += 1
+            try:
+                while not self._can_grant(site, host):
+                    remaining = 1.0 if deadline is None else deadline - time.monotonic()
+                    if not blocking or remaining <= 0: return False
+                    self.cond.wait(timeout=min(remaining, 1.0))
+                self.used += 1
+                self.per_host[host] += 1
+                self.per_site[site] += 1
+                return True
+            finally:
+                self.waiting[(site, host)] -= 1
+
+    def release(self, site, host):
+        with self.cond:
+            self.used -= 1
+            self.per_host[host] -= 1
+            self.per_site[site] -= 1
+            self.cond.notify_all()
+
+    def should_yield(self, site, host):
+        """True se il sito è oltre la quota e altri siti aspettano: l'operaio dovrebbe cedere la connessione."""
+        with self.cond:
+            return self.per_site[site] > self.fair_share() and self._others_starving(site, host)
+
+def is_congestion_error(e):
+    """Errori che indicano un server sovraccarico o un limite di sessioni raggiunto (4xx, connessione persa)."""
+    return isinstance(e, (ftplib.error_temp, EOFError, ConnectionError, socket.timeout))
+
+class FileInventory:
+    """Elenco compatto dei file in attesa di download, pensato per alberi da milioni di file.
+    Ogni cartella è memorizzata una sola volta (indice in `dirs`); ogni file è un record binario
+    (indice della cartella, dimensione, nome e data di modifica in UTF-8) accodato in blocchi da
+    INVENTORY_CHUNK_SIZE byte, invece di una tupla con due percorsi completi: circa 40 byte più il
+    nome. I record stanno in una coda per classe di dimensione (potenze di due) e escono dalla
+    classe più grande, in ordine di scoperta. I blocchi letti vengono liberati; oltre
+    `memory_limit` byte quelli nuovi finiscono in un file temporaneo in `spill_dir`."""
+    RECORD = struct.Struct('<IQH')  # cartella, dimensione, lunghezza del resto del record
+    UNKNOWN_SIZE = 2 ** 64 - 1  # Dimensione assente da MLSD (None): esce per prima, con i file più grandi
+
+    def __init__(self, memory_limit=INVENTORY_MEMORY_LIMIT, spill_dir=None):
+        self.memory_limit = INVENTORY_MEMORY_LIMIT if memory_limit is None else memory_limit
+        self.spill_dir = spill_dir
+        self.spill = None
+        self.spill_size = 0
+        self.in_memory = 0
+        self.dirs = []  # [(cartella remota, cartella locale)]
+        self.dir_index = {}
+        self.chunks = [deque() for _ in range(65)]  # Per size.bit_length(): bytes, o (offset, lunghezza) su disco
+        self.tails = [bytearray() for _ in range(65)]  # Blocco in scrittura
+        self.heads = [b''] * 65  # Blocco in lettura e posizione del prossimo record
+        self.positions = [0] * 65
+        self.counts = [0] * 65
+        self.count = 0
+        self.top = 0  # Classe più grande che può contenere file
+
+    def __len__(self):
+        return self.count
+
+    def put(self, item):
+        remote_path, local_path, size, modify = item
+        remote_dir, _, name = remote_path.rpartition('/')
+        local_dir, local_name = os.path.split(local_path)
+        key = (remote_dir, local_dir)
+        dir_id = self.dir_index.get(key)
+        if dir_id is None:
+            dir_id = self.dir_index[key] = len(self.dirs)
+            self.dirs.append(key)
+        # Il nome locale si salva solo se diverso da quello remoto (mai, con l'albero di cartelle)
+        fields = (name, modify) if local_name == name else (name, modify, local_name)
+        data = '\0'.join(fields).encode('utf-8', 'surrogatepass')
+        if size is None: size = self.UNKNOWN_SIZE
+        bucket = min(size.bit_length(), 64)
+        tail = self.tails[bucket]
+        tail += self.RECORD.pack(dir_id, size, len(data))
+        tail += data
+        if len(tail) >= INVENTORY_CHUNK_SIZE: self._seal(bucket)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.top = max(self.top, bucket)
+
+    def _seal(self, bucket):
+        """Il blocco in scrittura passa in coda: in memoria, o su disco oltre memory_limit."""
+        chunk = bytes(self.tails[bucket])
+        self.tails[bucket] = bytearray()
+        if self.in_memory + len(chunk) > self.memory_limit:
+            if self.spill is None: self.spill = tempfile.TemporaryFile(prefix='.inventory_', dir=self.spill_dir)
+            self.spill.seek(self.spill_size)
+            self.spill.write(chunk)
+            self.chunks[bucket].append((self.spill_size, len(chunk)))
+            self.spill_size += len(chunk)
+        else:
+            self.chunks[bucket].append(chunk)
+            self.in_memory += len(chunk)
+
+    def _head(self, bucket):
+        """Blocco da cui leggere il prossimo record della classe: prima i blocchi in coda, poi quello in scrittura."""
+        if self.positions[bucket] < len(self.heads[bucket]): return self.heads[bucket]
+        chunks = self.chunks[bucket]
+        if chunks:
+            chunk = chunks.popleft()
+            if isinstance(chunk, tuple):
+                self.spill.seek(chunk[0])
+                chunk = self.spill.read(chunk[1])
+            else:
+                self.in_memory -= len(chunk)
+        else:
+            chunk = bytes(self.tails[bucket])
+            self.tails[bucket] = bytearray()
+        self.heads[bucket], self.positions[bucket] = chunk, 0
+        return chunk
+
+    def _top_bucket(self):
+        while self.top and not self.counts[self.top]: self.top -= 1
+        return self.top
+
+    def peek_size(self):
+        """Dimensione del prossimo file che uscirebbe da pop() (None se l'elenco è vuoto; UNKNOWN_SIZE se ignota)."""
+        if not self.count: return None
+        bucket = self._top_bucket()
+        return self.RECORD.unpack_from(self._head(bucket), self.positions[bucket])[1]
+
+    def pop(self):
+        """Prossimo file (remote_path, local_path, size, modify): dalla classe di dimensione più grande."""
+        bucket = self._top_bucket()
+        head, position = self._head(bucket), self.positions[bucket]
+        dir_id, size, length = self.RECORD.unpack_from(head, position)
+        start = position + self.RECORD.size
+        fields = head[start:start + length].decode('utf-8', 'surrogatepass').split('\0')
+        self.positions[bucket] = start + length
+        self.counts[bucket] -= 1
+        self.count -= 1
+        remote_dir, local_dir = self.dirs[dir_id]
+        return (f"{remote_dir}/{fields[0]}", os.path.join(local_dir, fields[-1] if len(fields) > 2 else fields[0]),
+                None if size == self.UNKNOWN_SIZE else size, fields[1])
+
+    def drain(self):
+        items = [self.pop() for _ in range(self.count)]
+        self.close()
+        return items
+
+    def close(self):
+        if self.spill:
+            self.spill.close()
+            self.spill, self.spill_size = None, 0
+
+class WorkScheduler:
+    """Coda di lavoro ordinata per dimensione: gli operai prendono sempre un file della classe di
+    dimensione più grande disponibile, così gli archivi enormi partono subito e i file piccoli
+    riempiono la coda finale. I file in attesa stanno in un FileInventory compatto, consumato
+    man mano che la scansione lo riempie. Adatta il numero di operai attivi (AIMD): dimezza sugli
+    errori del server e ne riattiva uno alla volta finché la velocità complessiva continua a crescere
+    (un operaio in più che non porta guadagno viene tolto, e il tentativo successivo attende)."""
+    THROUGHPUT_GAIN = 1.05  # Un operaio in più deve portare almeno il +5% di velocità
+    PROBE_HOLD_WINDOWS = 6  # Finestre di attesa dopo un operaio in più che non ha aumentato la velocità
+    PENDING = object()  # get(block=False): nessun file disponibile per ora
+
+    def __init__(self, max_workers, on_adjust=None, inventory=None):
+        self.cond = threading.Condition()
+        self.inventory = inventory or FileInventory()
+        self.closed = False
+        self.max_workers = max_workers
+        self.active_limit = max_workers
+        self.on_adjust = on_adjust
+        self.bytes_done = 0
+        self.errors = 0
+        self.window_start = time.monotonic()
+        self.last_rate = 0.0
+        self.probing = False
+        self.hold_windows = 0
+        self.last_decrease = 0.0
+
+    def put(self, item):
+        with self.cond:
+            self.inventory.put(item)
+            self.cond.notify()
+
+    def close(self):
+        """Segnala che la scansione è finita: gli operai escono quando la coda si svuota."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get(self, worker_id, on_park=None, block=True):
+        """Prossimo file per l'operaio `worker_id`, o None a lavoro finito. Gli operai oltre il limite
+        attivo restano in attesa; `on_park` viene chiamato (una volta) prima di parcheggiarli.
+        Con block=False (motore asyncio) restituisce PENDING invece di attendere."""
+        while True:
+            with self.cond:
+                while True:
+                    self._maybe_adapt()
+                    if self.inventory.count and worker_id < self.active_limit:
+                        return self.inventory.pop()
+                    if self.closed and not self.inventory.count: return None
+                    if worker_id >= self.active_limit and on_park: break
+                    if not block: return self.PENDING
+                    self.cond.wait(timeout=1.0)
+            # Chiusura della connessione fuori dal lock: libera la sessione sul server
+            on_park()
+            on_park = None
+
+    def get_batch(self, worker_id, on_park=None, block=True):
+        """Come get(), ma restituisce una lista: se il file è piccolo preleva insieme altri file piccoli
+        (fino a SMALL_FILE_BATCH, senza sottrarre tutto il lavoro rimasto agli altri operai)."""
+        item = self.get(worker_id, on_park, block)
+        if item is None: return []
+        if item is self.PENDING: return item
+        batch = [item]
+        if item[2] is not None and item[2] <= SMALL_FILE_THRESHOLD:
+            with self.cond:
+                limit = min(SMALL_FILE_BATCH, max(1, len(self.inventory) // max(self.active_limit, 1)))
+                while self.inventory.count and len(batch) < limit and self.inventory.peek_size() <= SMALL_FILE_THRESHOLD:
+                    batch.append(self.inventory.pop())
+        return batch
+
+    def drain(self):
+        """Svuota la coda e restituisce i file rimasti (nessun operaio in grado di scaricarli)."""
+        with self.cond: return self.inventory.drain()
+
+    def is_parked(self, worker_id):
+        return worker_id >= self.active_limit
+
+    def record_bytes(self, n):
+        with self.cond: self.bytes_done += n
+
+    def report_error(self, e):
+        """Un errore di congestione dimezza subito gli operai attivi."""
+        if not is_congestion_error(e): return
+        with self.cond:
+            self.errors += 1
+            # Una sola riduzione per finestra: gli errori simultanei di più operai sono lo stesso segnale
+            if time.monotonic() - self.last_decrease < SCHEDULER_ADAPT_INTERVAL: return
+            new_limit = max(1, self.active_limit // 2)
+            if new_limit < self.active_limit:
+                self.last_decrease = time.monotonic()
+                self.active_limit = new_limit
+                self.probing = False
+                self._reset_window()
+                if self.on_adjust: self.on_adjust(self.active_limit, self.max_workers, 'errors')
+
+    def _reset_window(self):
+        self.window_start, self.bytes_done, self.errors = time.monotonic(), 0, 0
+
+    def _maybe_adapt(self):
+        elapsed = time.monotonic() - self.window_start
+        if elapsed < SCHEDULER_ADAPT_INTERVAL: return
+        rate = self.bytes_done / elapsed
+        if self.probing and (self.errors or rate < self.last_rate * self.THROUGHPUT_GAIN):
+            # Nessun guadagno dall'ultimo operaio aggiunto: si torna al limite precedente e si
+            # aspetta qualche finestra prima di riprovare
+            self.probing = False
+            self.active_limit -= 1
+            self.hold_windows = self.PROBE_HOLD_WINDOWS
+            if self.on_adjust: self.on_adjust(self.active_limit, self.max_workers, 'throughput')
+        elif self.hold_windows and not self.probing:
+            self.hold_windows -= 1
+        elif self.errors or self.active_limit >= self.max_workers:
+            self.probing = False
+        else:
+            # Primo tentativo, o l'ultimo operaio aggiunto ha aumentato la velocità: se ne prova un altro
+            self.active_limit += 1
+            self.probing = True
+            self.cond.notify_all()
+            if self.on_adjust: self.on_adjust(self.active_limit, self.max_workers, 'throughput')
+        self.last_rate = rate
+        self._reset_window()
+
+class ConnectionPool:
+    """Sessioni FTP già autenticate condivise da scansione e download: le connessioni della scansione
+    passano agli operai invece di essere chiuse, quelle inattive ricevono un NOOP ogni
+    POOL_KEEPALIVE_INTERVAL secondi e quelle cadute vengono sostituite con nuovi login a backoff
+    esponenziale. Le sessioni aperte non superano mai `max_sessions` (né il budget condiviso)."""
+    def __init__(self, run, max_sessions):
+        self.run = run
+        self.cond = threading.Condition()
+        self.max_sessions = max_sessions
+        self.open = 0
+        self.idle = []  # [(ftp, ultimo utilizzo)]
+        self.closed = False
+        self.keepalive_thread = None
+        self.logins = self.reused = self.dropped = 0
+
+    def adopt(self, ftp):
+        """Registra come in uso una sessione aperta altrove (la connessione principale)."""
+        with self.cond: self.open += 1
+        return ftp
+
+    def get(self, blocking=True):
+        """Una sessione pronta: prima quelle inattive (verificate con NOOP se ferme da tempo), altrimenti
+        un nuovo login. None se il limite è raggiunto (non bloccante) o il server resta irraggiungibile."""
+        while True:
+            with self.cond:
+                while not self.idle and self.open >= self.max_sessions:
+                    if not blocking: return None
+                    self.cond.wait(timeout=1.0)
+                if self.idle:
+                    ftp, last_used = self.idle.pop()
+                else:
+                    ftp = None
+                    self.open += 1
+            if ftp is None:
+                # Budget condiviso esaurito: si riprova a brevi intervalli, perché nel frattempo
+                # un altro operaio può restituire al pool una sessione già aperta
+                if self.run.acquire_slot(blocking, timeout=1.0): return self._connect(blocking)
+                with self.cond:
+                    self.open -= 1
+                    self.cond.notify()
+                if not blocking: return None
+                continue
+            if time.monotonic() - last_used < POOL_KEEPALIVE_INTERVAL or self._alive(ftp):
+                with self.cond: self.reused += 1
+                return ftp
+            self.discard(ftp, dead=True)
+
+    def _connect(self, blocking):
+        # Il posto nel budget è già prenotato: lo si libera se tutti i tentativi falliscono
+        run, creds = self.run, self.run.ftp_creds
+        attempts = MAX_CONNECT_FAILURES if blocking else 1
+        for attempt in range(1, attempts + 1):
+            run.pace_command()
+            started = time.monotonic()
+            ftp = connect_ftp(creds['host'], creds['user'], creds['pass'], run.t, creds.get('port', 21))
+            run.metrics.connected(time.monotonic() - started, bool(ftp))
+            if ftp:
+                with self.cond: self.logins += 1
+                return ftp
+            if attempt < attempts: time.sleep(min(2 ** attempt, 30))
+        run.release_slot()
+        with self.cond:
+            self.open -= 1
+            self.cond.notify()
+        return None
+
+    def record(self, logins=0, dropped=0):
+        """Contatori per le connessioni aperte fuori dal pool (motore asyncio)."""
+        with self.cond:
+            self.logins += logins
+            self.dropped += dropped
+
+    def _alive(self, ftp):
         try:
-            spinner_text = f'\r {Colors.GREEN}{t["STATUS_DISCOVERING"]}{next(spinner)}{Colors.RESET}'
-            sys.stdout.write(spinner_text)
-            sys.stdout.flush()
-            # Rallentiamo un po' l'animazione per renderla più visibile
-            time.sleep(0.08) 
-        except (ValueError, TypeError):
+            ftp.voidcmd('NOOP')
+            return True
+        except Exception:
+            # Anche un socket già chiuso (AttributeError in ftplib) significa sessione persa
+            return False
+
+    def put(self, ftp):
+        """Restituisce una sessione sana: il prossimo get() la riusa senza un nuovo login. Se altri
+        siti aspettano una connessione del budget condiviso, la sessione viene invece chiusa."""
+        with self.cond:
+            if not self.closed and not self.run.should_yield():
+                self.idle.append((ftp, time.monotonic()))
+                self.cond.notify()
+                if not self.keepalive_thread:
+                    self.keepalive_thread = threading.Thread(target=self._keepalive, daemon=True)
+                    self.keepalive_thread.start()
+                return
+        self.discard(ftp)
+
+    def discard(self, ftp, dead=False):
+        """Chiude una sessione (QUIT, o solo il socket se è già caduta) e libera il suo posto."""
+        try:
+            if dead: ftp.close()
+            else: ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+        finally:
+            self.run.release_slot()
+            with self.cond:
+                self.open -= 1
+                if dead: self.dropped += 1
+                self.cond.notify()
+
+    def _keepalive(self):
+        # Le sessioni ferme da troppo escono dal pool durante il NOOP, così nessuno le preleva a metà
+        while True:
+            with self.cond:
+                self.cond.wait(timeout=POOL_KEEPALIVE_INTERVAL)
+                if self.closed: return
+                now = time.monotonic()
+                stale = [entry for entry in self.idle if now - entry[1] >= POOL_KEEPALIVE_INTERVAL]
+                self.idle = [entry for entry in self.idle if now - entry[1] < POOL_KEEPALIVE_INTERVAL]
+            for ftp, _ in stale:
+                if self._alive(ftp): self.put(ftp)
+                else: self.discard(ftp, dead=True)
+
+    def close(self):
+        """Fine esecuzione: chiude le sessioni inattive; quelle restituite dopo vengono chiuse subito."""
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.cond.notify_all()
+        for ftp, _ in idle: self.discard(ftp)
+
+class Histogram:
+    """Istogramma cumulativo in stile Prometheus (limiti superiori `bounds`), con somma, conteggio e massimo."""
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = self.max = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+class SiteMetrics:
+    """Metriche di un backup: durata delle fasi, latenza di login e MLSD, dimensione e velocità dei
+    file scaricati, contatori. Sempre attive (costano un paio di letture dell'orologio per file o
+    cartella) perché alimentano il riepilogo finale; con una Telemetry ogni misura diventa anche
+    un evento JSON."""
+    HISTOGRAMS = {'connect_seconds': LATENCY_BUCKETS, 'mlsd_seconds': LATENCY_BUCKETS,
+                  'file_size_bytes': FILE_SIZE_BUCKETS, 'file_throughput_bytes_per_second': THROUGHPUT_BUCKETS}
+
+    def __init__(self, label, telemetry=None):
+        self.label = label
+        self.telemetry = telemetry
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = defaultdict(int)
+        self.histograms = {name: Histogram(bounds) for name, bounds in self.HISTOGRAMS.items()}
+        self.started = time.time()
+        self.first_byte = None  # Secondi dall'avvio al primo blocco di dati ricevuto
+        self.result = None  # Riepilogo di run_backup, a backup concluso
+
+    def emit(self, event, **fields):
+        if self.telemetry: self.telemetry.emit({'ts': round(time.time(), 3), 'site': self.label, 'event': event, **fields})
+
+    def observe(self, name, value):
+        with self.lock: self.histograms[name].observe(value)
+
+    def count(self, name, n=1):
+        with self.lock: self.counters[name] += n
+
+    def phase(self, name, seconds):
+        with self.lock: self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.emit('phase', phase=name, seconds=round(seconds, 4))
+
+    def connected(self, seconds, ok):
+        """Durata di connessione e login (anche falliti)."""
+        if ok: self.observe('connect_seconds', seconds)
+        self.count('logins' if ok else 'login_failures')
+        self.emit('connect', seconds=round(seconds, 4), ok=ok)
+
+    def listed(self, remote_path, seconds, entries):
+        self.observe('mlsd_seconds', seconds)
+        self.count('listings')
+        self.emit('list', path=remote_path, seconds=round(seconds, 4), entries=entries)
+
+    def received(self):
+        """Primo blocco di dati arrivato (tempo al primo byte); le chiamate successive non contano."""
+        with self.lock:
+            if self.first_byte is not None: return
+            self.first_byte = time.time() - self.started
+        self.emit('first_byte', seconds=round(self.first_byte, 4))
+
+    def downloaded(self, remote_path, size, seconds, transferred=None):
+        """File scaricato e verificato. La velocità si registra solo oltre SMALL_FILE_THRESHOLD:
+        per i file piccoli conta quasi solo la latenza. `transferred` sono i byte ricevuti davvero
+        (meno di `size` se il file è stato ripreso con REST)."""
+        if transferred is None: transferred = size
+        if self.first_byte is None: self.received()  # I file piccoli arrivano a lotti: qui è più preciso
+        with self.lock:
+            self.histograms['file_size_bytes'].observe(size)
+            if transferred > SMALL_FILE_THRESHOLD and seconds > 0:
+                self.histograms['file_throughput_bytes_per_second'].observe(transferred / seconds)
+            self.counters['files'] += 1
+            self.counters['bytes'] += transferred
+        self.emit('file', path=remote_path, bytes=transferred, seconds=round(seconds, 4),
+                  **({'resumed': size - transferred} if transferred != size else {}))
+
+    def retried(self, remote_path, e):
+        self.count('retries')
+        self.emit('retry', path=remote_path, error=str(e))
+
+    def failed(self, remote_path, e):
+        self.count('failures')
+        self.emit('failed', path=remote_path, error=str(e))
+
+    def summary(self):
+        with self.lock:
+            download = self.phases.get('download', 0.0)
+            return {
+                'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                **self.counters,
+                'connect_mean_seconds': round(self.histograms['connect_seconds'].mean(), 4),
+                'mlsd_mean_seconds': round(self.histograms['mlsd_seconds'].mean(), 4),
+                'mlsd_max_seconds': round(self.histograms['mlsd_seconds'].max, 4),
+                'throughput_bytes_per_second': round(self.counters['bytes'] / download) if download else 0,
+                'first_byte_seconds': round(self.first_byte, 4) if self.first_byte is not None else None,
+            }
+
+class Telemetry:
+    """Raccolta delle metriche di tutti i siti del processo: eventi JSON lines in `metrics_file`
+    (connessioni, elenchi, file, nuovi tentativi, fasi e un riepilogo per sito) e, a fine
+    esecuzione, un file di testo Prometheus in `prometheus_file` (textfile collector di
+    node_exporter), scritto in modo atomico."""
+    def __init__(self, metrics_file=None, prometheus_file=None):
+        self.lock = threading.Lock()
+        self.prometheus_file = prometheus_file
+        self.f = open(metrics_file, 'a', encoding='utf-8') if metrics_file else None
+        self.sites = []
+
+    def site(self, label):
+        metrics = SiteMetrics(label, self)
+        with self.lock: self.sites.append(metrics)
+        return metrics
+
+    def emit(self, record):
+        if not self.f: return
+        line = json.dumps(record) + '\n'
+        with self.lock: self.f.write(line)
+
+    def finish_site(self, metrics, result):
+        """Fine del backup di un sito: riepilogo nel file di eventi ed esito per Prometheus."""
+        metrics.result = result
+        metrics.emit('summary', **metrics.summary(), failed=result['failed'])
+
+    def prometheus_text(self):
+        lines = []
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP ftp_backup_{name} {help_text}")
+            lines.append(f"# TYPE ftp_backup_{name} {kind}")
+            for labels, value in samples:
+                rendered = ','.join(f'{key}="{prometheus_escape(val)}"' for key, val in labels.items())
+                lines.append(f"ftp_backup_{name}{{{rendered}}} {value}")
+        sites = list(self.sites)
+        family('last_run_timestamp_seconds', 'gauge', "Start of the last backup.", [({'site': m.label}, round(m.started)) for m in sites])
+        family('last_run_success', 'gauge', "1 if the last backup completed with no failed files.",
+               [({'site': m.label}, int(bool(m.result) and not m.result['failed'])) for m in sites])
+        family('phase_seconds', 'gauge', "Duration of each backup phase.",
+               [({'site': m.label, 'phase': phase}, round(seconds, 4)) for m in sites for phase, seconds in m.phases.items()])
+        family('first_byte_seconds', 'gauge', "Time from the start of the backup to the first byte downloaded.",
+               [({'site': m.label}, round(m.first_byte, 4)) for m in sites if m.first_byte is not None])
+        for counter, help_text in (('files', "Files downloaded."), ('bytes', "Bytes downloaded."), ('listings', "MLSD listings."),
+                                   ('logins', "FTP logins."), ('login_failures', "Failed FTP logins."),
+                                   ('retries', "Files or folders retried."), ('failures', "Files given up on.")):
+            family(f"{counter}_total", 'counter', help_text, [({'site': m.label}, m.counters.get(counter, 0)) for m in sites])
+        for name, bounds in SiteMetrics.HISTOGRAMS.items():
+            lines.append(f"# HELP ftp_backup_{name} Histogram of {name.replace('_', ' ')}.")
+            lines.append(f"# TYPE ftp_backup_{name} histogram")
+            for m in sites:
+                histogram, site_label = m.histograms[name], prometheus_escape(m.label)
+                cumulative = 0
+                for bound, count in zip(list(bounds) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'ftp_backup_{name}_bucket{{site="{site_label}",le="{bound}"}} {cumulative}')
+                lines.append(f'ftp_backup_{name}_sum{{site="{site_label}"}} {round(histogram.sum, 4)}')
+                lines.append(f'ftp_backup_{name}_count{{site="{site_label}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.prometheus_file:
+            # Scrittura atomica: il collector non deve mai leggere un file a metà
+            tmp_path = f"{self.prometheus_file}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: f.write(self.prometheus_text())
+            os.replace(tmp_path, self.prometheus_file)
+        if self.f:
+            with self.lock: self.f.close()
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class BackupRun:
+    """Stato condiviso di un'esecuzione: credenziali, scheduler dei download, barra di avanzamento,
+    statistiche di scansione, indice dei backup precedenti, registro dell'esecuzione e filtri
+    include/exclude, budget di connessioni e limiti di banda e di comandi/s (opzionali), pool delle
+    sessioni FTP (al massimo `max_sessions`, di default una per operaio), se l'uscita è un archivio
+    il BackupArchive in cui finiscono i file al posto dell'albero di cartelle e, se attiva la verifica,
+    il VerificationReport dell'esecuzione; `metrics` (SiteMetrics) raccoglie tempi e contatori."""
+    def __init__(self, ftp_creds, t, scheduler, pbar_overall, manifest=None, journal=None, include=None, exclude=None,
+                 label=None, budget=None, bandwidth=None, max_sessions=None, archive=None, verifier=None, commands=None, limits=None,
+                 metrics=None):
+        self.ftp_creds = ftp_creds
+        self.t = t
+        self.scheduler = scheduler
+        self.pbar_overall = pbar_overall
+        self.manifest = manifest
+        self.journal = journal
+        self.site = f"{ftp_creds['user']}@{ftp_creds['host']}"
+        self.stats = DiscoveryStats()
+        self.known_dirs = set()
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.label = label or self.site
+        self.budget = budget
+        self.bandwidth = [bucket for bucket in (bandwidth or []) if bucket]
+        self.commands = [bucket for bucket in (commands or []) if bucket]
+        self.limits = limits  # HostLimits da tenere aggiornati durante l'esecuzione
+        self.metrics = metrics or SiteMetrics(self.label)
+        self.pool = ConnectionPool(self, max_sessions or scheduler.max_workers)
+        self.retries = {}  # remote_path -> tentativi dopo una connessione caduta
+        self.archive = archive
+        self.verifier = verifier
+
+    def acquire_slot(self, blocking=True, timeout=None):
+        """Prenota una connessione nel budget condiviso (sempre concessa se non c'è un budget)."""
+        return not self.budget or self.budget.acquire(self.label, self.ftp_creds['host'], blocking, timeout)
+
+    def release_slot(self):
+        if self.budget: self.budget.release(self.label, self.ftp_creds['host'])
+
+    def should_yield(self):
+        return bool(self.budget) and self.budget.should_yield(self.label, self.ftp_creds['host'])
+
+    def throttle_delay(self, n):
+        """Secondi da attendere dopo aver ricevuto n byte per rispettare i limiti di banda."""
+        if self.limits: self.limits.maybe_reload()
+        return max((bucket.reserve(n) for bucket in self.bandwidth), default=0.0)
+
+    def command_delay(self):
+        """Secondi da attendere prima del prossimo comando (MLSD, RETR, hash, login) per i limiti di comandi/s."""
+        if not self.commands: return 0.0
+        if self.limits: self.limits.maybe_reload()
+        return max(bucket.reserve(1) for bucket in self.commands)
+
+    def pace_command(self):
+        delay = self.command_delay()
+        if delay: time.sleep(delay)
+
+    def wants_dir(self, remote_path):
+        """Le cartelle escluse non vengono nemmeno esplorate."""
+        return not any(fnmatch.fnmatchcase(remote_path, pattern) for pattern in self.exclude)
+
+    def wants_file(self, remote_path):
+        """Glob sul percorso remoto completo (es. '*.log', '/public_html/cache/*'): l'esclusione vince."""
+        if any(fnmatch.fnmatchcase(remote_path, pattern) for pattern in self.exclude): return False
+        return not self.include or any(fnmatch.fnmatchcase(remote_path, pattern) for pattern in self.include)
+
+    def ensure_dir(self, local_dir):
+        """os.makedirs una sola volta per cartella (le cartelle create dalla scansione sono già note).
+        Con l'uscita in archivio la cartella viene solo annotata per l'archivio."""
+        if local_dir in self.known_dirs: return
+        if self.archive: self.archive.add_dir(local_dir)
+        else: os.makedirs(local_dir, exist_ok=True)
+        self.known_dirs.add(local_dir)
+
+    def save_small_file(self, local_path, data, modify):
+        """Salva un file già in memoria; ritorna il riferimento per l'indice (percorso locale o blob)."""
+        if not self.archive:
+            write_whole_file(local_path, data)
+            return local_path
+        return self.archive.segment().add_file(self.archive.member_name(local_path), data, mlsd_timestamp(modify))
+
+    def reuse_unchanged(self, remote_path, local_path, size, modify):
+        """Se il file non è cambiato dall'ultimo backup lo collega dalla copia precedente. Ritorna True se riusato."""
+        if not self.manifest or not modify: return False
+        previous = self.manifest.lookup(self.site, remote_path)
+        if not previous: return False
+        prev_size, prev_modify, prev_local_path = previous
+        if prev_size != size or prev_modify != modify: return False
+        if self.archive:
+            # Store deduplicato: nell'indice c'è il blob, basta citarlo nel nuovo snapshot
+            if not self.archive.reuse(local_path, prev_local_path, size, mlsd_timestamp(modify)): return False
+            local_path = prev_local_path
+        else:
+            try:
+                # Una copia locale troncata (es. download interrotto) non è riutilizzabile
+                if os.path.getsize(prev_local_path) != size: return False
+                if not os.path.exists(local_path) or not os.path.samefile(prev_local_path, local_path):
+                    if os.path.lexists(local_path): os.remove(local_path)
+                    link_or_copy(prev_local_path, local_path)
+            except OSError:
+                return False
+        self.manifest.record(self.site, remote_path, size, modify, local_path)
+        if self.journal: self.journal.mark_done(remote_path, size)
+        return True
+
+    def new_hasher(self):
+        """Hash da aggiornare blocco per blocco durante la ricezione (None se la verifica è disattivata)."""
+        return self.verifier.new_hasher() if self.verifier else None
+
+    def check_size(self, remote_path, size, received):
+        """Confronto con la dimensione di MLSD, sempre attivo: un trasferimento troncato non passa per buono.
+        Se MLSD non ha dato la dimensione (None) resta solo la verifica dell'hash."""
+        if size is None or received == size: return
+        if self.verifier: self.verifier.mismatch(remote_path, 'size', size, received)
+        raise IntegrityError(self.t['ERR_SIZE_CHANGED'].format(expected=size, actual=received))
+
+    def should_retry(self, remote_path, e=None):
+        """Conta un nuovo tentativo per `remote_path` dopo una connessione caduta; False oltre MAX_FILE_RETRIES."""
+        with self.stats.lock:
+            attempts = self.retries[remote_path] = self.retries.get(remote_path, 0) + 1
+            if attempts > MAX_FILE_RETRIES: return False
+            self.stats.retried_count += 1
+        self.metrics.retried(remote_path, e)
+        return True
+
+    def retry_later(self, item, e):
+        """Il file torna nello scheduler per un'altra sessione; esauriti i tentativi viene contato come fallito."""
+        if self.should_retry(item[0], e): self.scheduler.put(item)
+        else: self.report_failure(item[0], e)
+
+    def report_failure(self, remote_path, e):
+        with self.stats.lock: self.stats.failed_count += 1
+        if self.verifier: self.verifier.failed(remote_path, e)
+        self.metrics.failed(remote_path, e)
+        with tqdm_lock: tqdm.write(self.t['ERR_DOWNLOAD_FILE'].format(filename=os.path.basename(remote_path), e=e))
+
+    def record_batch(self, completed):
+        """Indice e registro per un lotto di file completati [(remote, ref, size, modify), ...]. Un errore
+        di scrittura non annulla i file salvati, ma va segnalato: quei file verranno riscaricati."""
+        try:
+            if self.manifest: self.manifest.record_many([(self.site, r, size, modify, l) for r, l, size, modify in completed])
+        except Exception as e:
+            with tqdm_lock: tqdm.write(self.t['ERR_RECORD_BATCH'].format(count=len(completed), e=e))
+        # Il registro si aggiorna anche se l'indice ha fallito: servono a cose diverse
+        try:
+            if self.journal: self.journal.mark_done_many([(r, size) for r, _, size, _ in completed])
+        except Exception as e:
+            with tqdm_lock: tqdm.write(self.t['ERR_RECORD_BATCH'].format(count=len(completed), e=e))
+
+    def add_progress(self, n):
+        if self.metrics.first_byte is None: self.metrics.received()
+        self.pbar_overall.update(n)
+        self.scheduler.record_bytes(n)
+
+    def add_resumed(self, n):
+        """Byte già su disco di un file ripreso con REST: avanzano la barra ma non sono trasferiti
+        in questa esecuzione, quindi non entrano nella velocità misurata dallo scheduler."""
+        self.pbar_overall.update(n)
+
+    def already_done(self, remote_path, local_path):
+        """True se il file è stato completato da un'esecuzione interrotta che stiamo riprendendo."""
+        return bool(self.journal) and self.journal.is_done(remote_path) and os.path.isfile(local_path)
+
+def discovery_worker(ftp, frontier, run):
+    """Operaio di scansione: preleva cartelle dalla frontiera condivisa, le elenca con MLSD
+    e spinge subito i file trovati nello scheduler dei download (le sottocartelle tornano nella frontiera).
+    Se la connessione cade la cartella viene rielencata su una nuova sessione del pool; a fine
+    scansione la sessione passa al pool, dove la riprendono gli operai di download."""
+    stats = run.stats
+    while True:
+        item = frontier.get()
+        if item is None:
+            frontier.task_done()
             break
-            
-    sys.stdout.write('\r' + ' ' * 60 + '\r')
-    sys.stdout.flush()
+        remote_path, local_path = item
+        try:
+            if ftp is None: ftp = run.pool.get()
+            if ftp is None: raise ConnectionError(run.t['ERR_CONNECTION_FAILED'].format(host=run.ftp_creds['host']))
+            run.ensure_dir(local_path)
+            files_in_dir = 0
+            run.pace_command()
+            started = time.monotonic()
+            entries = list(ftp.mlsd(remote_path))
+            run.metrics.listed(remote_path, time.monotonic() - started, len(entries))
+            for name, facts in entries:
+                if name in ['.', '..']: continue
+                next_remote_path, next_local_path = f"{remote_path}/{name}", os.path.join(local_path, name)
+                if facts.get('type') == 'dir':
+                    if run.wants_dir(next_remote_path): frontier.put((next_remote_path, next_local_path))
+                elif facts.get('type') == 'file':
+                    if not run.wants_file(next_remote_path): continue
+                    # 'size' è facoltativo (RFC 3659): senza, la dimensione si scopre scaricando (None)
+                    size, modify = int(facts['size']) if 'size' in facts else None, facts.get('modify', '')
+                    files_in_dir += 1
+                    if run.already_done(next_remote_path, next_local_path):
+                        with stats.lock:
+                            stats.file_count += 1
+                            stats.already_done_count += 1
+                        continue
+                    if run.reuse_unchanged(next_remote_path, next_local_path, size, modify):
+                        with stats.lock:
+                            stats.file_count += 1
+                            stats.unchanged_count += 1
+                            stats.unchanged_size += size
+                        continue
+                    run.scheduler.put((next_remote_path, next_local_path, size, modify))
+                    with stats.lock:
+                        stats.file_count += 1
+                        stats.total_size += size or 0
+                    with tqdm_lock: run.pbar_overall.total += size or 0
+            if files_in_dir:
+                with stats.lock: stats.dir_count += 1
+        except Exception as e:
+            if is_congestion_error(e):
+                # MLSD legge l'elenco completo prima di restituirlo: rielencare non duplica i file
+                if ftp: run.pool.discard(ftp, dead=True)
+                ftp = None
+                if run.should_retry(remote_path, e):
+                    frontier.put(item)
+                    continue
+            with tqdm_lock: tqdm.write(run.t['ERR_EXPLORE_DIR'].format(path=remote_path, e=e))
+        finally:
+            # Le sottocartelle sono già in frontiera: il join() termina solo a scansione completa
+            frontier.task_done()
+    if ftp: run.pool.put(ftp)
+
+def discover_files_parallel(ftp_main, roots, run, num_listers=DISCOVERY_CONNECTIONS):
+    """Scansiona in parallelo gli alberi remoti `roots` [(remote, local), ...] con un pool di
+    connessioni che condividono una frontiera di cartelle. Blocca fino a scansione completa.
+    Le connessioni aggiuntive si aprono solo se pool e budget condiviso ne hanno di libere subito."""
+    connections = [run.pool.adopt(ftp_main)]
+    for _ in range(max(num_listers, 1) - 1):
+        ftp = run.pool.get(blocking=False)
+        if ftp: connections.append(ftp)
+
+    frontier = Queue()
+    for root in roots: frontier.put(root)
+
+    listers = []
+    for ftp in connections:
+        thread = threading.Thread(target=discovery_worker, args=(ftp, frontier, run), daemon=True)
+        thread.start()
+        listers.append(thread)
+
+    frontier.join()
+    for _ in listers: frontier.put(None)
+    for thread in listers: thread.join()
+    return run.stats
+
+class ProgressCoalescer:
+    """Accumula i byte di un trasferimento e li passa a `sink` (barra + scheduler) al massimo
+    ogni PROGRESS_INTERVAL secondi, invece che a ogni blocco. Il primo blocco passa subito, così
+    il tempo al primo byte delle metriche non dipende dall'intervallo."""
+    def __init__(self, sink):
+        self.sink = sink
+        self.pending = 0
+        self.last_flush = float('-inf')
+
+    def __call__(self, n):
+        self.pending += n
+        now = time.monotonic()
+        if now - self.last_flush >= PROGRESS_INTERVAL: self.flush(now)
+
+    def flush(self, now=None):
+        if self.pending:
+            self.sink(self.pending)
+            self.pending = 0
+        self.last_flush = now or time.monotonic()
+
+def preallocate(f, offset, size):
+    """Riserva in anticipo lo spazio su disco per il file (meno frammentazione), dove supportato."""
+    if size and size > offset and hasattr(os, 'posix_fallocate'):
+        try: os.posix_fallocate(f.fileno(), offset, size - offset)
+        except OSError: pass  # Filesystem senza supporto (es. alcuni FS di rete): si scrive normalmente
+
+def write_all(f, view):
+    """f.write su un file non bufferizzato può scrivere meno byte di quelli richiesti."""
+    while view: view = view[f.write(view):]
+
+def hash_prefix(f, length, hasher, buffer):
+    """Ripresa con REST: l'hash deve coprire anche i byte già su disco, riletti solo in questo caso."""
+    f.seek(0)
+    while length:
+        n = f.readinto(buffer[:min(length, len(buffer))])
+        if not n: break
+        hasher.update(buffer[:n])
+        length -= n
+
+def transfer_buffer():
+    """Buffer di TRANSFER_BLOCKSIZE byte del thread corrente, allocato al primo file e poi riusato:
+    con molti file l'allocazione (e l'azzeramento) di 1 MiB per file costerebbe più della ricezione."""
+    buffer = getattr(transfer_buffers, 'buffer', None)
+    if buffer is None: buffer = transfer_buffers.buffer = memoryview(bytearray(TRANSFER_BLOCKSIZE))
+    return buffer
 
-def discover_files_recursive(ftp, remote_path, local_path, file_list, t):
+def retrieve_file(ftp, remote_file_path, local_file_path, offset, progress, size=0, checkpoint=None, throttle=None, hasher=None,
+                  resumed=None):
+    """Scarica un file remoto ricevendo direttamente (recv_into) nel buffer del thread (transfer_buffer)
+    di TRANSFER_BLOCKSIZE byte, scritto su disco solo quando è pieno, senza copie intermedie.
+    Con offset > 0 riprende dai byte mancanti (REST) e passa a `resumed` i byte già su disco
+    (`progress` riceve solo quelli trasferiti); con la dimensione nota il file viene preallocato.
+    `checkpoint(bytes_scritti)` viene chiamato ogni JOURNAL_CHECKPOINT_BYTES;
+    `throttle(n)` restituisce i secondi di pausa per rispettare i limiti di banda; `hasher`
+    riceve ogni blocco scritto. Ritorna la dimensione finale del file."""
+    buffer = transfer_buffer()
+    with open(local_file_path, 'r+b' if offset else 'wb', buffering=0) as f:
+        if offset:
+            if hasher: hash_prefix(f, offset, hasher, buffer)
+            f.seek(offset)
+            if resumed: resumed(offset)
+        preallocate(f, offset, size)
+        position, next_checkpoint = offset, offset + JOURNAL_CHECKPOINT_BYTES
+        try:
+            ftp.voidcmd('TYPE I')
+            with ftp.transfercmd(f'RETR {remote_file_path}', offset or None) as conn:
+                filled = 0
+                while True:
+                    n = conn.recv_into(buffer[filled:])
+                    filled += n
+                    if n and filled < len(buffer): continue
+                    if filled:
+                        write_all(f, buffer[:filled])
+                        if hasher: hasher.update(buffer[:filled])
+                        position += filled
+                        progress(filled)
+                        delay = throttle(filled) if throttle else 0
+                        if delay: time.sleep(delay)
+                        filled = 0
+                        if checkpoint and position >= next_checkpoint:
+                            checkpoint(position)
+                            next_checkpoint = position + JOURNAL_CHECKPOINT_BYTES
+                    if not n: break
+            ftp.voidresp()
+        except ftplib.error_perm:
+            if offset:
+                if resumed: resumed(-offset)
+                progress(offset - position)
+            raise
+        finally:
+            # Toglie la coda preallocata se il file remoto è più corto o il trasferimento si è interrotto
+            f.truncate(position)
+    return position
+
+def write_whole_file(local_file_path, data):
+    """Scrive un file piccolo con un solo open/write/close a livello di sistema operativo."""
+    fd = os.open(local_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
     try:
-        ftp.cwd(remote_path)
-        os.makedirs(local_path, exist_ok=True)
-        items = list(ftp.mlsd())
-        for name, facts in items:
-            if name in ['.', '..']: continue
-            next_remote_path, next_local_path = f"{remote_path}/{name}", os.path.join(local_path, name)
-            if facts.get('type') == 'dir':
-                discover_files_recursive(ftp, next_remote_path, next_local_path, file_list, t)
-            elif facts.get('type') == 'file':
-                file_list.append((next_remote_path, next_local_path, int(facts.get('size', 0))))
-    except Exception as e:
-        with tqdm_lock: tqdm.write(t['ERR_EXPLORE_DIR'].format(path=remote_path, e=e))
+        view = memoryview(data)
+        while view: view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def mlsd_timestamp(modify):
+    """Il fatto 'modify' di MLSD (YYYYMMDDHHMMSS, UTC) come timestamp; l'ora attuale se manca."""
+    try: return datetime.strptime(modify[:14], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError): return time.time()
+
+def derive_archive_key(password, salt):
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=100000, backend=default_backend())
+    return kdf.derive(password.encode())
+
+class EncryptedWriter:
+    """Flusso cifrato con AES-256-GCM, scritto senza file temporanei: intestazione MAGIC + sale +
+    prefisso del nonce, poi blocchi [ultimo?][lunghezza][testo cifrato + tag] da ARCHIVE_CHUNK_SIZE
+    byte in chiaro. Il nonce contiene il numero del blocco e il flag di chiusura è autenticato:
+    blocchi riordinati o un archivio troncato vengono rifiutati da decrypt_archive()."""
+    MAGIC = b'FTPBKENC\x01'
+
+    def __init__(self, raw, password):
+        salt, self.prefix = os.urandom(16), os.urandom(8)
+        self.aead = AESGCM(derive_archive_key(password, salt))
+        self.raw = raw
+        self.buffer = bytearray()
+        self.counter = 0
+        raw.write(self.MAGIC + salt + self.prefix)
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= ARCHIVE_CHUNK_SIZE:
+            sealed = 0
+            while len(self.buffer) - sealed >= ARCHIVE_CHUNK_SIZE:
+                self._seal(self.buffer[sealed:sealed + ARCHIVE_CHUNK_SIZE], last=False)
+                sealed += ARCHIVE_CHUNK_SIZE
+            del self.buffer[:sealed]
+        return len(data)
+
+    def _seal(self, chunk, last):
+        flag = b'\x01' if last else b'\x00'
+        sealed = self.aead.encrypt(self.prefix + self.counter.to_bytes(4, 'big'), chunk, flag)
+        self.raw.write(flag + len(sealed).to_bytes(4, 'big') + sealed)
+        self.counter += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Cifra il blocco finale (anche vuoto, è il segno di archivio completo); non chiude `raw`."""
+        self._seal(self.buffer, last=True)
+        self.buffer.clear()
+
+def decrypt_archive(source, destination, password):
+    """Decifra un archivio .enc scritto da EncryptedWriter. Solleva ValueError se la password è
+    errata o l'archivio è stato alterato o troncato."""
+    header_size = len(EncryptedWriter.MAGIC) + 24
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        header = src.read(header_size)
+        if len(header) < header_size or not header.startswith(EncryptedWriter.MAGIC): raise ValueError("not an encrypted backup archive")
+        salt, prefix = header[-24:-8], header[-8:]
+        aead, counter = AESGCM(derive_archive_key(password, salt)), 0
+        while True:
+            record = src.read(5)
+            if len(record) < 5: raise ValueError("truncated archive")
+            flag, length = record[:1], int.from_bytes(record[1:], 'big')
+            sealed = src.read(length)
+            try:
+                dst.write(aead.decrypt(prefix + counter.to_bytes(4, 'big'), sealed, flag))
+            except InvalidTag:
+                raise ValueError("wrong password or corrupted archive")
+            counter += 1
+            if flag == b'\x01': break
+
+class TarEntry:
+    """Membro tar in scrittura: accetta al massimo `size` byte (dichiarati nell'intestazione) e alla
+    chiusura completa con zeri un trasferimento interrotto, così il segmento resta leggibile."""
+    def __init__(self, segment, size):
+        self.segment = segment
+        self.size = size
+        self.remaining = size
+        self.received = 0
+
+    def write(self, data):
+        self.received += len(data)
+        if self.remaining <= 0: return
+        if len(data) > self.remaining: data = data[:self.remaining]
+        self.segment.write(data)
+        self.remaining -= len(data)
+
+    def finish(self):
+        """Padding fino alla dimensione dichiarata e al blocco da 512 byte; ritorna i byte ricevuti."""
+        while self.remaining > 0:
+            zeros = min(self.remaining, TRANSFER_BLOCKSIZE)
+            self.segment.write(bytes(zeros))
+            self.remaining -= zeros
+        self.segment.write(bytes(-self.size % tarfile.BLOCKSIZE))
+        return self.received
+
+    abort = finish  # Il membro interrotto resta, completato con zeri: il nuovo tentativo lo sostituisce
+
+class ZipEntry:
+    def __init__(self, handle):
+        self.handle = handle
+        self.received = 0
+
+    def write(self, data):
+        self.received += len(data)
+        self.handle.write(data)
+
+    def finish(self):
+        self.handle.close()
+        return self.received
 
-def download_worker(q, pbar_overall, ftp_creds, t):
-    ftp = connect_ftp(ftp_creds['host'], ftp_creds['user'], ftp_creds['pass'], t)
-    if not ftp:
+    abort = finish
+
+class ArchiveSegment:
+    """Un segmento d'archivio scritto in streaming da un solo operaio: compressione (gzip, zstd o zip)
+    sopra l'eventuale cifratura, sopra il file. Il tar viene scritto a mano (TarInfo.tobuf) perché
+    tarfile terrebbe in memoria l'elenco di tutti i membri."""
+    warnings_lock = threading.Lock()  # catch_warnings cambia i filtri di tutto il processo: un segmento alla volta
+
+    def __init__(self, path, archive_format, password=None):
+        self.path = path
+        self.format = archive_format
+        self.offset = 0
+        raw = open(path, 'wb', buffering=TRANSFER_BLOCKSIZE)
+        self.layers = [raw]  # Dal più esterno al più interno, chiusi in quest'ordine
+        if password: self.layers.insert(0, EncryptedWriter(raw, password))
+        if archive_format == 'tar.gz':
+            self.layers.insert(0, gzip.GzipFile(fileobj=self.layers[0], mode='wb', compresslevel=ARCHIVE_COMPRESSION_LEVEL))
+        elif archive_format == 'tar.zst':
+            compressor = zstandard.ZstdCompressor(level=ARCHIVE_COMPRESSION_LEVEL)
+            self.layers.insert(0, compressor.stream_writer(self.layers[0], closefd=False))
+        self.zip = None
+        if archive_format == 'zip':
+            self.zip = zipfile.ZipFile(self.layers[0], 'w', zipfile.ZIP_DEFLATED, compresslevel=ARCHIVE_COMPRESSION_LEVEL)
+
+    def write(self, data):
+        self.layers[0].write(data)
+        self.offset += len(data)
+
+    def begin(self, name, size, mtime):
+        """Apre il membro `name` di `size` byte; i dati arrivano con entry.write(), poi entry.finish()."""
+        if self.zip:
+            info = zipfile.ZipInfo(name, datetime.fromtimestamp(max(mtime, 315532800)).timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # Un file ritentato compare due volte nello zip (in estrazione vale l'ultima copia): l'avviso
+            # di zipfile viene zittito solo qui, senza toccare i filtri del resto del processo
+            with self.warnings_lock, warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message='Duplicate name', category=UserWarning)
+                handle = self.zip.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT)
+            return ZipEntry(handle)
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = size, int(mtime), 0o644
+        self.write(info.tobuf(tarfile.PAX_FORMAT))
+        return TarEntry(self, size)
+
+    def add_file(self, name, data, mtime):
+        entry = self.begin(name, len(data), mtime)
+        entry.write(data)
+        entry.finish()
+
+    def add_dir(self, name):
+        if self.zip:
+            self.zip.writestr(zipfile.ZipInfo(name + '/'), b'')
+            return
+        info = tarfile.TarInfo(name)
+        info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, int(time.time())
+        self.write(info.tobuf(tarfile.PAX_FORMAT))
+
+    def close(self):
+        if self.zip:
+            self.zip.close()
+        else:
+            # Fine archivio: due blocchi vuoti, poi padding al record come fa tarfile
+            self.write(bytes(2 * tarfile.BLOCKSIZE))
+            self.write(bytes(-self.offset % tarfile.RECORDSIZE))
+        for layer in self.layers: layer.close()
+
+class BackupArchive:
+    """Uscita in archivio invece dell'albero di cartelle: ogni operaio scrive nel proprio segmento
+    (part-NN.<formato>[.enc] nella cartella del backup), senza lock condivisi né file temporanei.
+    Le cartelle raccolte dalla scansione vengono scritte nel primo segmento alla chiusura."""
+    def __init__(self, root, archive_format, password=None):
+        self.root = root
+        self.format = archive_format
+        self.password = password
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.segments = []
+        self.dirs = set()
+
+    def member_name(self, local_path):
+        return os.path.relpath(local_path, self.root).replace(os.sep, '/')
+
+    def add_dir(self, local_dir):
+        name = self.member_name(local_dir)
+        if name != '.':
+            with self.lock: self.dirs.add(name)
+
+    def segment(self):
+        """Il segmento dell'operaio corrente, creato al primo file che scarica."""
+        segment = getattr(self.local, 'segment', None)
+        if segment is None:
+            with self.lock:
+                suffix = '.enc' if self.password else ''
+                path = os.path.join(self.root, f"part-{len(self.segments):02d}.{self.format}{suffix}")
+                segment = ArchiveSegment(path, self.format, self.password)
+                self.segments.append(segment)
+            self.local.segment = segment
+        return segment
+
+    def close(self):
+        first = self.segments[0] if self.segments else self.segment()
+        for name in sorted(self.dirs): first.add_dir(name)
+        for segment in self.segments: segment.close()
+
+class StoreBusyError(Exception):
+    """prune_store(): uno snapshot è ancora in scrittura (backup in corso); il messaggio è il suo percorso."""
+
+class StoreLock:
+    """flock su store.lock: backup e ripristini lo prendono condiviso, il prune esclusivo, così un blob
+    appena collegato o scritto da un backup non può essere cancellato prima che finisca nello snapshot.
+    Il lock si rilascia chiudendo il file (anche se il processo muore)."""
+    def __init__(self, store_dir, exclusive=False):
+        self.path = os.path.join(store_dir, STORE_LOCK_FILE)
+        self.f = open(self.path, 'a+b')
+        if not fcntl: return
         try:
-            q.get_nowait()
-            q.task_done()
-        except Queue.empty: pass
+            # Il prune non aspetta: se un backup è in corso si rinuncia. Un backup aspetta la fine del prune
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+        except BlockingIOError:
+            self.f.close()
+            raise StoreBusyError(self.path) from None
+
+    def close(self):
+        self.f.close()
+
+class BlobEntry:
+    """File in arrivo verso il BlobStore: scritto in store/tmp e hashato blocco per blocco."""
+    def __init__(self, store, name, mtime):
+        self.store, self.name, self.mtime = store, name, mtime
+        self.hasher = hashlib.sha256()
+        self.received = 0
+        self.ref = None
+        self.tmp_path = store.tmp_file()
+        self.file = open(self.tmp_path, 'wb', buffering=TRANSFER_BLOCKSIZE)
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.file.write(data)
+        self.received += len(data)
+
+    def finish(self):
+        self.file.close()
+        self.ref = self.store.commit_blob(self.tmp_path, self.hasher.hexdigest(), self.received)
+        self.store.add_entry(self.name, self.ref, self.received, self.mtime)
+        return self.received
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+class BlobStore:
+    """Archivio deduplicato per contenuto, condiviso tra esecuzioni e siti: ogni contenuto diverso è
+    salvato una sola volta in blobs/ab/cd/<sha256>, con l'hash calcolato mentre i dati arrivano
+    (nessuna rilettura dal disco). Ogni backup è uno snapshot, un elenco compresso di percorsi e hash
+    in snapshots/<sito>/<nome>.jsonl.gz, reso definitivo solo a backup concluso. Ha la stessa
+    interfaccia di BackupArchive, quindi gli operai lo usano allo stesso modo."""
+    def __init__(self, store_dir, root, site_label, header):
+        self.store_dir = store_dir
+        self.root = root
+        self.tmp_dir = os.path.join(store_dir, 'tmp')
+        self.blobs_dir = os.path.join(store_dir, 'blobs')
+        snapshots_dir = os.path.join(store_dir, 'snapshots', site_label.replace('/', '_').replace(os.sep, '_'))
+        for directory in (self.tmp_dir, self.blobs_dir, snapshots_dir): os.makedirs(directory, exist_ok=True)
+        self.store_lock = StoreLock(store_dir)
+        base_name, counter = os.path.join(snapshots_dir, os.path.basename(root)), 1
+        self.snapshot_path = base_name + SNAPSHOT_SUFFIX
+        # Due backup nello stesso secondo non devono sovrascriversi lo snapshot
+        while os.path.exists(self.snapshot_path) or os.path.exists(self.snapshot_path + '.partial'):
+            counter += 1
+            self.snapshot_path = f"{base_name}_{counter}{SNAPSHOT_SUFFIX}"
+        self.lock = threading.Lock()
+        self.known_dirs = set()
+        self.segments = [self]
+        self.snapshot = gzip.open(self.snapshot_path + '.partial', 'wt', encoding='utf-8', compresslevel=ARCHIVE_COMPRESSION_LEVEL)
+        self.snapshot.write(json.dumps(header) + '\n')
+        self.files = self.total_size = 0
+        self.new_blobs = self.new_size = self.deduplicated = self.deduplicated_size = 0
+
+    def member_name(self, local_path):
+        return os.path.relpath(local_path, self.root).replace(os.sep, '/')
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest[:2], digest[2:4], digest)
+
+    def tmp_file(self):
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.tmp")
+
+    def segment(self):
+        return self
+
+    def begin(self, name, size, mtime):
+        return BlobEntry(self, name, mtime)
+
+    def add_file(self, name, data, mtime):
+        """File piccolo già in memoria: viene scritto solo se il suo contenuto non è già nello store."""
+        digest = hashlib.sha256(data).hexdigest()
+        tmp_path = None
+        if not os.path.exists(self.blob_path(digest)):
+            tmp_path = self.tmp_file()
+            write_whole_file(tmp_path, data)
+        ref = self.commit_blob(tmp_path, digest, len(data))
+        self.add_entry(name, ref, len(data), mtime)
+        return ref
+
+    def commit_blob(self, tmp_path, digest, size):
+        """Sposta il file scaricato tra i blob, o lo scarta se quel contenuto è già presente."""
+        final_path = self.blob_path(digest)
+        if os.path.exists(final_path):
+            if tmp_path: os.remove(tmp_path)
+            with self.lock:
+                self.deduplicated += 1
+                self.deduplicated_size += size
+        else:
+            blob_dir = os.path.dirname(final_path)
+            if blob_dir not in self.known_dirs:
+                os.makedirs(blob_dir, exist_ok=True)
+                self.known_dirs.add(blob_dir)
+            os.chmod(tmp_path, 0o444)  # I blob sono condivisi tra snapshot: mai modificarli sul posto
+            os.replace(tmp_path, final_path)
+            with self.lock:
+                self.new_blobs += 1
+                self.new_size += size
+        return f"blob:{digest}"
+
+    def reuse(self, local_path, ref, size, mtime):
+        """Backup incrementale: un file invariato entra nello snapshot senza essere riscaricato,
+        purché il suo blob esista ancora (un prune potrebbe averlo rimosso)."""
+        if not ref.startswith('blob:') or not os.path.exists(self.blob_path(ref[5:])): return False
+        self.add_entry(self.member_name(local_path), ref, size, mtime)
+        return True
+
+    def add_entry(self, name, ref, size, mtime):
+        with self.lock:
+            self.snapshot.write(json.dumps({'path': name, 'sha256': ref[5:], 'size': size, 'mtime': int(mtime)}) + '\n')
+            self.files += 1
+            self.total_size += size
+
+    def add_dir(self, local_dir):
+        name = self.member_name(local_dir)
+        if name != '.':
+            with self.lock: self.snapshot.write(json.dumps({'dir': name}) + '\n')
+
+    def close(self):
+        """Chiude lo snapshot e lo rende definitivo (rinomina atomica del file .partial)."""
+        with self.lock:
+            self.snapshot.write(json.dumps({'finished': datetime.now().isoformat(timespec='seconds'),
+                                            'files': self.files, 'bytes': self.total_size}) + '\n')
+            self.snapshot.close()
+        os.replace(self.snapshot_path + '.partial', self.snapshot_path)
+        self.store_lock.close()
+
+def read_snapshot(path):
+    """Righe di uno snapshot: intestazione, cartelle ({'dir'}), file ({'path', 'sha256', ...}) e chiusura."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f: yield json.loads(line)
+
+def restore_snapshot(snapshot_path, destination):
+    """Ricostruisce un normale albero di cartelle da uno snapshot copiando i blob (mai collegandoli:
+    una modifica al file ripristinato altererebbe lo store). Ritorna (file, byte)."""
+    store_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(snapshot_path))))
+    blobs_dir = os.path.join(store_dir, 'blobs')
+    files = total_size = 0
+    # Un prune non deve cancellare i blob mentre vengono copiati
+    store_lock = StoreLock(store_dir)
+    try:
+        for entry in read_snapshot(snapshot_path):
+            if 'dir' in entry:
+                os.makedirs(os.path.join(destination, entry['dir']), exist_ok=True)
+            elif 'sha256' in entry:
+                digest, target = entry['sha256'], os.path.join(destination, entry['path'])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(blobs_dir, digest[:2], digest[2:4], digest), target)
+                os.utime(target, (entry['mtime'], entry['mtime']))
+                files += 1
+                total_size += entry['size']
+    finally:
+        store_lock.close()
+    return files, total_size
+
+def prune_store(store_dir, keep_last=None, keep_days=None):
+    """Politica di conservazione per sito: restano gli ultimi `keep_last` snapshot e quelli degli
+    ultimi `keep_days` giorni (basta una delle due condizioni), poi i blob non più referenziati da
+    nessuno snapshot vengono cancellati. Ritorna (snapshot rimossi, blob rimossi, byte liberati).
+    Solleva StoreBusyError se un backup sta scrivendo nello store o un ripristino lo sta leggendo."""
+    if not os.path.isdir(store_dir): return 0, 0, 0
+    # Esclusivo: nessun backup può collegare o scrivere blob mentre si decide quali cancellare
+    store_lock = StoreLock(store_dir, exclusive=True)
+    try:
+        snapshots_root = os.path.join(store_dir, 'snapshots')
+        site_dirs = [os.path.join(snapshots_root, site) for site in sorted(os.listdir(snapshots_root))] if os.path.isdir(snapshots_root) else []
+        now = time.time()
+        for site_dir in site_dirs:
+            for name in os.listdir(site_dir):
+                # I blob di un backup in corso non sono ancora in nessuno snapshot completo
+                if name.endswith('.partial') and now - os.path.getmtime(os.path.join(site_dir, name)) < STORE_PARTIAL_GRACE:
+                    raise StoreBusyError(os.path.join(site_dir, name))
+
+        kept, removed_snapshots = [], 0
+        for site_dir in site_dirs:
+            names = os.listdir(site_dir)
+            snapshots = sorted(((os.path.getmtime(os.path.join(site_dir, name)), os.path.join(site_dir, name))
+                                for name in names if name.endswith(SNAPSHOT_SUFFIX)), reverse=True)
+            for index, (mtime, path) in enumerate(snapshots):
+                if (keep_last is not None and index < keep_last) or (keep_days is not None and now - mtime < keep_days * 86400):
+                    kept.append(path)
+                else:
+                    os.remove(path)
+                    removed_snapshots += 1
+            # Snapshot rimasti a metà da esecuzioni interrotte da tempo
+            for name in names:
+                if name.endswith('.partial'): os.remove(os.path.join(site_dir, name))
+
+        referenced = set()
+        for path in kept:
+            referenced.update(entry['sha256'] for entry in read_snapshot(path) if 'sha256' in entry)
+        removed_blobs = freed = 0
+        for directory, _, names in os.walk(os.path.join(store_dir, 'blobs')):
+            for name in names:
+                if name in referenced: continue
+                path = os.path.join(directory, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removed_blobs += 1
+        # File temporanei di download interrotti
+        tmp_dir = os.path.join(store_dir, 'tmp')
+        for name in os.listdir(tmp_dir) if os.path.isdir(tmp_dir) else []: os.remove(os.path.join(tmp_dir, name))
+        return removed_snapshots, removed_blobs, freed
+    finally:
+        store_lock.close()
+
+def verify_download(ftp, run, remote_file_path, size, received, hasher):
+    """Controlli a trasferimento concluso: dimensione di MLSD e, con la verifica attiva, hash calcolato
+    in ricezione confrontato con quello del server. Solleva IntegrityError se il file va riscaricato."""
+    run.check_size(remote_file_path, size, received)
+    if not run.verifier: return
+    command, server_digest = run.verifier.server_command(remote_file_path), None
+    if command:
+        run.pace_command()
+        try: server_digest = run.verifier.parse_digest(ftp.sendcmd(command))
+        except ftplib.error_perm: pass  # Hash rifiutato per questo file (es. troppo grande): resta l'hash locale
+    run.verifier.check(remote_file_path, size, hasher, server_digest, run.t)
+
+def fetch_small_files(ftp, batch, run):
+    """Percorso veloce per un lotto di file piccoli: TYPE I una sola volta per lotto (retrbinary lo
+    ripete a ogni file), lettura completa in memoria e una sola scrittura su disco per file.
+    Avanzamento, indice e registro vengono aggiornati una volta per lotto. Un file che non supera la
+    verifica torna nello scheduler; se la connessione cade, il file in corso viene ritentato, gli
+    altri tornano nello scheduler e l'errore viene propagato."""
+    completed, transferred = [], 0
+    try:
+        ftp.voidcmd('TYPE I')
+    except Exception as e:
+        if is_congestion_error(e):
+            for item in batch: run.scheduler.put(item)
+            raise
+        for item in batch: run.report_failure(item[0], e)
         return
+    try:
+        for index, (remote_file_path, local_file_path, size, modify) in enumerate(batch):
+            try:
+                run.ensure_dir(os.path.dirname(local_file_path))
+                data = bytearray()
+                run.pace_command()
+                started = time.monotonic()
+                with ftp.transfercmd(f'RETR {remote_file_path}') as conn:
+                    while True:
+                        chunk = conn.recv(SMALL_FILE_THRESHOLD)
+                        if not chunk: break
+                        data += chunk
+                ftp.voidresp()
+                hasher = run.new_hasher()
+                if hasher: hasher.update(data)
+                verify_download(ftp, run, remote_file_path, size, len(data), hasher)
+                ref = run.save_small_file(local_file_path, data, modify)
+                run.metrics.downloaded(remote_file_path, len(data), time.monotonic() - started)
+                transferred += len(data)
+                completed.append((remote_file_path, ref, size, modify))
+                delay = run.throttle_delay(len(data))
+                if delay: time.sleep(delay)
+            except Exception as e:
+                if is_congestion_error(e):
+                    run.retry_later(batch[index], e)
+                    for item in batch[index + 1:]: run.scheduler.put(item)
+                    raise
+                if isinstance(e, IntegrityError): run.retry_later(batch[index], e)
+                else: run.report_failure(remote_file_path, e)
+    finally:
+        if transferred: run.add_progress(transferred)
+        if completed: run.record_batch(completed)
+
+def retrieve_to_archive(ftp, remote_file_path, entry, progress, throttle=None, hasher=None):
+    """Come retrieve_file, ma ogni blocco ricevuto passa subito al membro d'archivio `entry`
+    (compressione e cifratura in streaming, nessun file temporaneo)."""
+    buffer = transfer_buffer()
+    ftp.voidcmd('TYPE I')
+    with ftp.transfercmd(f'RETR {remote_file_path}') as conn:
+        while True:
+            n = conn.recv_into(buffer)
+            if not n: break
+            entry.write(buffer[:n])
+            if hasher: hasher.update(buffer[:n])
+            progress(n)
+            delay = throttle(n) if throttle else 0
+            if delay: time.sleep(delay)
+    ftp.voidresp()
+
+def archive_file(ftp, item, run):
+    """Percorso dei file grandi con l'uscita in archivio: il membro viene dichiarato con la dimensione
+    di MLSD; se il trasferimento si interrompe o non supera la verifica viene completato con zeri e
+    il file ritentato (in estrazione vale l'ultima copia; lo store scarta il blob)."""
+    remote_file_path, local_file_path, size, modify = item
+    if size is None:
+        # Un membro tar dichiara la dimensione prima dei dati: se MLSD non l'ha data la si chiede con SIZE
+        ftp.voidcmd('TYPE I')
+        size = ftp.size(remote_file_path)
+        if size is None: raise ftplib.error_reply(f"SIZE {remote_file_path}")
+    entry = run.archive.segment().begin(run.archive.member_name(local_file_path), size, mlsd_timestamp(modify))
+    # Lo store calcola già lo SHA-256 del contenuto: se la verifica usa lo stesso algoritmo non lo si ripete
+    shared = isinstance(entry, BlobEntry) and run.verifier and run.verifier.algorithm == 'sha256'
+    hasher = entry.hasher if shared else run.new_hasher()
+    progress = ProgressCoalescer(run.add_progress)
+    run.pace_command()
+    started = time.monotonic()
+    try:
+        retrieve_to_archive(ftp, remote_file_path, entry, progress, run.throttle_delay if run.bandwidth else None,
+                            None if shared else hasher)
+        verify_download(ftp, run, remote_file_path, size, entry.received, hasher)
+    except BaseException:
+        entry.abort()
+        raise
+    finally:
+        progress.flush()
+    entry.finish()
+    run.metrics.downloaded(remote_file_path, size, time.monotonic() - started)
+    if run.manifest: run.manifest.record(run.site, remote_file_path, size, modify, entry.ref)
+
+def fetch_file(ftp, item, run):
+    """Scarica un singolo file (percorso normale, per i file grandi) con ripresa REST."""
+    if run.archive: return archive_file(ftp, item, run)
+    remote_file_path, local_file_path, size, modify = item
+    run.ensure_dir(os.path.dirname(local_file_path))
+    # Un file parziale lasciato da un'esecuzione interrotta riprende dall'offset già scritto (REST)
+    offset = run.journal.resume_offset(remote_file_path, local_file_path, size, modify) if run.journal else 0
+    # Da zero si scrive un file nuovo: quello esistente potrebbe essere collegato al backup precedente
+    if not offset and os.path.lexists(local_file_path): os.remove(local_file_path)
+    checkpoint = None
+    if run.journal:
+        run.journal.begin(remote_file_path, size, modify, offset)
+        checkpoint = lambda written: run.journal.checkpoint(remote_file_path, written)
+    progress = ProgressCoalescer(run.add_progress)
+    throttle = run.throttle_delay if run.bandwidth else None
+    hasher = run.new_hasher()
+    run.pace_command()
+    started = time.monotonic()
+    try:
+        received = retrieve_file(ftp, remote_file_path, local_file_path, offset, progress, size, checkpoint, throttle, hasher,
+                                 run.add_resumed)
+    except ftplib.error_perm:
+        # Il server non supporta REST: si ricomincia da zero
+        if not offset: raise
+        hasher, offset = run.new_hasher(), 0
+        received = retrieve_file(ftp, remote_file_path, local_file_path, 0, progress, size, checkpoint, throttle, hasher)
+    finally:
+        progress.flush()
+    try:
+        verify_download(ftp, run, remote_file_path, size, received, hasher)
+    except IntegrityError:
+        # Una copia che non corrisponde non deve restare né fare da base a una ripresa
+        os.remove(local_file_path)
+        raise
+    if size is None: size = received
+    run.metrics.downloaded(remote_file_path, size, time.monotonic() - started, received - offset)
+    if run.manifest: run.manifest.record(run.site, remote_file_path, size, modify, local_file_path)
+    if run.journal: run.journal.mark_done(remote_file_path, size)
+
+def download_worker(run, worker_id):
+    """Operaio di download: usa le sessioni del pool e, se la connessione cade o il file non supera la
+    verifica, lo rimette in coda per un'altra sessione (fino a MAX_FILE_RETRIES volte) invece di perderlo."""
+    scheduler, pool = run.scheduler, run.pool
+    ftp, retry = None, None
+
+    def release(dead=False):
+        # Operaio sospeso dallo scheduler o oltre la quota: chiudiamo la sessione per non occupare il server
+        nonlocal ftp
+        if ftp:
+            pool.discard(ftp, dead)
+            ftp = None
+
+    while True:
+        if retry: batch, retry = retry, None
+        else: batch = scheduler.get_batch(worker_id, on_park=release, block=False)
+        if batch is WorkScheduler.PENDING:
+            # Niente da fare per ora: la sessione torna nel pool, che la tiene viva con i NOOP
+            if ftp:
+                pool.put(ftp)
+                ftp = None
+            batch = scheduler.get_batch(worker_id, on_park=release)
+        if not batch: break
+        if ftp is None:
+            ftp = pool.get()
+            if not ftp:
+                # Server irraggiungibile anche dopo i tentativi a backoff: i file restano in coda
+                for item in batch: scheduler.put(item)
+                scheduler.report_error(ConnectionError())
+                return
+        small = len(batch) > 1 or (batch[0][2] is not None and batch[0][2] <= SMALL_FILE_THRESHOLD)
+        try:
+            if small: fetch_small_files(ftp, batch, run)
+            else: fetch_file(ftp, batch[0], run)
+        except Exception as e:
+            scheduler.report_error(e)
+            if is_congestion_error(e): release(dead=True)
+            # Il percorso a lotti registra da sé fallimenti e nuovi tentativi; un errore diverso
+            # sarebbe un difetto, e non deve passare inosservato
+            if small:
+                if not is_congestion_error(e):
+                    with tqdm_lock: tqdm.write(run.t['ERR_DOWNLOAD_FILE'].format(filename=os.path.basename(batch[0][0]), e=e))
+            elif not is_congestion_error(e) and not isinstance(e, IntegrityError):
+                run.report_failure(batch[0][0], e)
+            elif run.archive:
+                # Il membro interrotto resta (completato con zeri) nel segmento di questo operaio:
+                # il nuovo tentativo va nello stesso segmento, subito dopo, così in estrazione vince
+                if run.should_retry(batch[0][0], e): retry = batch
+                else: run.report_failure(batch[0][0], e)
+            else:
+                run.retry_later(batch[0], e)
+        if run.should_yield(): release()
+    if ftp: pool.put(ftp)
+
+class AsyncFTPConnection:
+    """Client FTP minimale su asyncio per il motore asincrono: una connessione di controllo e
+    canali dati passivi (PASV), con gli stessi errori di ftplib (error_temp, error_perm, ...)."""
+    def __init__(self, host, port=21, timeout=60, encoding='utf-8'):
+        self.host, self.port, self.timeout, self.encoding = host, port, timeout, encoding
+        self.reader = self.writer = None
+
+    async def _readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line: raise EOFError
+        return line.decode(self.encoding, 'replace').rstrip('\r\n')
+
+    async def _read_response(self):
+        # Risposte multi-riga: "123-..." fino alla riga "123 ..."
+        line = await self._readline()
+        lines = [line]
+        if line[3:4] == '-':
+            code = line[:3]
+            while True:
+                line = await self._readline()
+                lines.append(line)
+                if line[:3] == code and line[3:4] != '-': break
+        resp = '\n'.join(lines)
+        if resp[:1] == '4': raise ftplib.error_temp(resp)
+        if resp[:1] == '5': raise ftplib.error_perm(resp)
+        if resp[:1] not in '123': raise ftplib.error_proto(resp)
+        return resp
+
+    async def _send(self, cmd):
+        self.writer.write((cmd + '\r\n').encode(self.encoding))
+        await self.writer.drain()
+
+    async def command(self, cmd, expect='2'):
+        await self._send(cmd)
+        resp = await self._read_response()
+        if resp[:1] not in expect: raise ftplib.error_reply(resp)
+        return resp
+
+    async def connect(self, user, password):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        await self._read_response()
+        if (await self.command(f'USER {user}', expect='23'))[:1] == '3':
+            await self.command(f'PASS {password}')
+        await self.command('TYPE I')
 
-    while not q.empty():
+    async def retrieve(self, remote_file_path, on_data, rest=0, throttle=None):
+        """RETR in modalità passiva; `on_data(chunk)` riceve i dati man mano che arrivano.
+        Legge solo quando il chiamante ha consumato il blocco precedente (backpressure TCP);
+        `throttle(n)` restituisce la pausa necessaria per i limiti di banda."""
+        _, port = ftplib.parse227(await self.command('PASV'))
+        data_reader, data_writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, port, limit=TRANSFER_BLOCKSIZE), self.timeout)
         try:
-            remote_file_path, local_file_path, _ = q.get_nowait()
+            if rest: await self.command(f'REST {rest}', expect='3')
+            await self.command(f'RETR {remote_file_path}', expect='1')
+            while True:
+                chunk = await asyncio.wait_for(data_reader.read(TRANSFER_BLOCKSIZE), self.timeout)
+                if not chunk: break
+                on_data(chunk)
+                delay = throttle(len(chunk)) if throttle else 0
+                if delay: await asyncio.sleep(delay)
+        finally:
+            data_writer.close()
+        await self._read_response()
+
+    async def close(self):
+        if not self.writer: return
+        try:
+            await asyncio.wait_for(self.command('QUIT'), 5)
+        except (ftplib.Error, OSError, EOFError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.writer.close()
+            self.writer = None
+
+async def async_retrieve_file(conn, remote_file_path, local_file_path, offset, progress, size=0, checkpoint=None, throttle=None,
+                              hasher=None, resumed=None):
+    """Equivalente asincrono di retrieve_file (scritture bufferizzate da TRANSFER_BLOCKSIZE byte)."""
+    with open(local_file_path, 'r+b' if offset else 'wb', buffering=TRANSFER_BLOCKSIZE) as f:
+        if offset:
+            if hasher: hash_prefix(f, offset, hasher, transfer_buffer())
+            f.seek(offset)
+            if resumed: resumed(offset)
+        preallocate(f, offset, size)
+        position, next_checkpoint = offset, offset + JOURNAL_CHECKPOINT_BYTES
+        def on_data(chunk):
+            nonlocal position, next_checkpoint
+            f.write(chunk)
+            if hasher: hasher.update(chunk)
+            position += len(chunk)
+            progress(len(chunk))
+            if checkpoint and position >= next_checkpoint:
+                f.flush()
+                checkpoint(position)
+                next_checkpoint = position + JOURNAL_CHECKPOINT_BYTES
+        try:
+            await conn.retrieve(remote_file_path, on_data, rest=offset, throttle=throttle)
+        except ftplib.error_perm:
+            if offset:
+                if resumed: resumed(-offset)
+                progress(offset - position)
+            raise
+        finally:
+            f.flush()
+            f.truncate(position)
+    return position
+
+async def async_verify_download(conn, run, remote_file_path, size, received, hasher):
+    """Equivalente asincrono di verify_download."""
+    run.check_size(remote_file_path, size, received)
+    if not run.verifier: return
+    command, server_digest = run.verifier.server_command(remote_file_path), None
+    if command:
+        delay = run.command_delay()
+        if delay: await asyncio.sleep(delay)
+        try: server_digest = run.verifier.parse_digest(await conn.command(command))
+        except ftplib.error_perm: pass
+    run.verifier.check(remote_file_path, size, hasher, server_digest, run.t)
+
+async def async_fetch_file(conn, item, run):
+    """Equivalente asincrono di fetch_file: ripresa REST, scrittura incrementale, registri."""
+    remote_file_path, local_file_path, size, modify = item
+    run.ensure_dir(os.path.dirname(local_file_path))
+    throttle = run.throttle_delay if run.bandwidth else None
+    delay = run.command_delay()
+    if delay: await asyncio.sleep(delay)
+    started = time.monotonic()
+    if size is not None and size <= SMALL_FILE_THRESHOLD:
+        data = bytearray()
+        await conn.retrieve(remote_file_path, data.extend, throttle=throttle)
+        offset, received = 0, len(data)
+        run.add_progress(received)
+        hasher = run.new_hasher()
+        if hasher: hasher.update(data)
+        await async_verify_download(conn, run, remote_file_path, size, len(data), hasher)
+        write_whole_file(local_file_path, data)
+    else:
+        offset = run.journal.resume_offset(remote_file_path, local_file_path, size, modify) if run.journal else 0
+        if not offset and os.path.lexists(local_file_path): os.remove(local_file_path)
+        checkpoint = None
+        if run.journal:
+            run.journal.begin(remote_file_path, size, modify, offset)
+            checkpoint = lambda written: run.journal.checkpoint(remote_file_path, written)
+        progress = ProgressCoalescer(run.add_progress)
+        hasher = run.new_hasher()
+        try:
+            received = await async_retrieve_file(conn, remote_file_path, local_file_path, offset, progress, size, checkpoint,
+                                                 throttle, hasher, run.add_resumed)
+        except ftplib.error_perm:
+            # Il server non supporta REST: si ricomincia da zero
+            if not offset: raise
+            hasher, offset = run.new_hasher(), 0
+            received = await async_retrieve_file(conn, remote_file_path, local_file_path, 0, progress, size, checkpoint,
+                                                 throttle, hasher)
+        finally:
+            progress.flush()
+        try:
+            await async_verify_download(conn, run, remote_file_path, size, received, hasher)
+        except IntegrityError:
+            os.remove(local_file_path)
+            raise
+        if size is None: size = received
+    run.metrics.downloaded(remote_file_path, size, time.monotonic() - started, received - offset)
+    if run.manifest: run.manifest.record(run.site, remote_file_path, size, modify, local_file_path)
+    if run.journal: run.journal.mark_done(remote_file_path, size)
+
+async def async_download_worker(run, worker_id):
+    """Operaio del motore asyncio: stesso scheduler e stessa gestione errori di download_worker,
+    ma una coroutine per connessione invece di un thread."""
+    scheduler, creds, t = run.scheduler, run.ftp_creds, run.t
+    conn, connect_failures, idle_sleep = None, 0, 0.01
+
+    async def close():
+        nonlocal conn
+        if conn:
+            await conn.close()
+            conn = None
+            run.release_slot()
+
+    while True:
+        batch = scheduler.get_batch(worker_id, block=False)
+        if not batch: break
+        if batch is WorkScheduler.PENDING:
+            # Niente da fare per ora (scansione in corso o operaio sospeso): attesa con backoff
+            if scheduler.is_parked(worker_id): await close()
+            await asyncio.sleep(idle_sleep)
+            idle_sleep = min(idle_sleep * 2, 0.5)
+            continue
+        idle_sleep = 0.01
+        if conn is None:
+            # Il budget condiviso non può bloccare l'event loop: si riprova senza attesa
+            if not run.acquire_slot(blocking=False):
+                for item in batch: scheduler.put(item)
+                await asyncio.sleep(0.1)
+                continue
+            conn = AsyncFTPConnection(creds['host'], creds.get('port', 21))
+            delay = run.command_delay()
+            if delay: await asyncio.sleep(delay)
+            started = time.monotonic()
+            try:
+                await conn.connect(creds['user'], creds['pass'])
+                run.metrics.connected(time.monotonic() - started, True)
+                run.pool.record(logins=1)
+                connect_failures = 0
+            except (ftplib.Error, OSError, EOFError, asyncio.TimeoutError) as e:
+                run.metrics.connected(time.monotonic() - started, False)
+                with tqdm_lock: tqdm.write(t['ERR_CONNECTION'].format(e=e))
+                await close()
+                for item in batch: scheduler.put(item)
+                scheduler.report_error(ConnectionError())
+                connect_failures += 1
+                if connect_failures >= MAX_CONNECT_FAILURES: return
+                await asyncio.sleep(min(2 ** connect_failures, 30))
+                continue
+        for index, item in enumerate(batch):
             try:
-                os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-                with open(local_file_path, 'wb') as f:
-                    def callback(data):
-                        f.write(data)
-                        pbar_overall.update(len(data))
-                    ftp.retrbinary(f'RETR {remote_file_path}', callback)
+                await async_fetch_file(conn, item, run)
             except Exception as e:
-                filename = os.path.basename(remote_file_path)
-                with tqdm_lock: tqdm.write(t['ERR_DOWNLOAD_FILE'].format(filename=filename, e=e))
-            finally:
-                q.task_done()
-        except Queue.empty: break
-    ftp.quit()
+                scheduler.report_error(e)
+                if is_congestion_error(e):
+                    # Connessione caduta: il file riparte su un'altra connessione, il resto del lotto torna in coda
+                    run.retry_later(item, e)
+                    for pending in batch[index + 1:]: scheduler.put(pending)
+                    run.pool.record(dropped=1)
+                    await close()
+                    break
+                if isinstance(e, IntegrityError): run.retry_later(item, e)
+                else: run.report_failure(item[0], e)
+        if run.should_yield(): await close()
+    await close()
+
+async def async_download_engine(run, num_connections):
+    await asyncio.gather(*(async_download_worker(run, worker_id) for worker_id in range(num_connections)))
+
+def run_async_engine(run, num_connections):
+    """Avvia il motore asyncio in un proprio event loop (chiamato da un thread dedicato)."""
+    asyncio.run(async_download_engine(run, num_connections))
+
+class BackupError(Exception):
+    """Errore fatale di un backup (connessione, configurazione, ripresa): il messaggio è già localizzato."""
+
+# Opzioni di run_backup(); il file di configurazione JSON (--config) usa le stesse chiavi
+DEFAULT_CONFIG = {
+    'host': None, 'port': 21, 'user': None,
+    'password': None, 'password_env': PASSWORD_ENV_VAR, 'password_file': None,
+    'dirs': None,  # Cartelle di primo livello da salvare; None = tutte
+    'backup_name': None,  # Parte variabile del nome della cartella di backup; None = automatica
+    'include': [], 'exclude': [],
+    'workers': DEFAULT_WORKERS, 'discovery_connections': DISCOVERY_CONNECTIONS,
+    'engine': 'threads', 'output_dir': None, 'incremental': INCREMENTAL_BACKUP,
+    'resume': None, 'lang': 'en', 'quiet': False,
+    'name': None,  # Nome del sito nei riepiloghi multi-sito; None = utente@host
+    'max_bandwidth': None,  # Limite di banda del sito, es. '20M' (byte/s); None = illimitato
+    'format': 'dir',  # Uno di OUTPUT_FORMATS
+    'store_dir': None,  # Con format 'store'; None = <output_dir>/store
+    'encrypt': False,  # Archivi cifrati (AES-GCM) con la password in ARCHIVE_PASSWORD_ENV_VAR
+    'verify': True,  # Hash in ricezione confrontato con quello del server (la dimensione si controlla sempre)
+    'max_commands': None,  # Comandi al secondo del sito (elenchi, download, hash, login); None = illimitato
+    'host_limits': None,  # {host: {'max_bandwidth', 'max_commands'}, '*': {...}} condivisi tra i siti dello stesso host
+    'limits_file': None,  # File JSON con gli host_limits, riletto quando cambia o con SIGHUP
+    'metrics_file': None,  # Eventi e riepilogo delle metriche in JSON lines (in coda al file)
+    'prometheus_file': None,  # Metriche per il textfile collector di node_exporter (riscritto a ogni esecuzione)
+    'inventory_memory': None,  # Memoria per i file in attesa, es. '64M' (oltre, su disco in output_dir); None = INVENTORY_MEMORY_LIMIT
+}
+
+def load_config_file(path, t):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        if not isinstance(config, dict): raise ValueError("JSON object expected")
+        return config
+    except (OSError, ValueError) as e:
+        raise BackupError(t['ERR_CONFIG_FILE'].format(path=path, e=e))
+
+def resolve_credentials(config, t):
+    """Credenziali senza prompt, in ordine: password nella configurazione, variabile d'ambiente,
+    file con la password, credentials.enc sbloccato dalla Master Password in MASTER_PASSWORD_ENV_VAR."""
+    host, user, password = config['host'], config['user'], config['password']
+    if not password and config['password_env']: password = os.environ.get(config['password_env'])
+    if not password and config['password_file']:
+        try:
+            with open(config['password_file'], 'r', encoding='utf-8') as f: password = f.read().strip()
+        except OSError as e:
+            raise BackupError(t['ERR_CONFIG_FILE'].format(path=config['password_file'], e=e))
+    master_password = os.environ.get(MASTER_PASSWORD_ENV_VAR)
+    if not password and master_password:
+        saved = CredentialsManager(os.path.join(SCRIPT_DIR, ENCRYPTED_CREDS_FILE)).load(master_password)
+        if not saved: raise BackupError(t['ERR_DECRYPT_FAILED'])
+        if host in (None, saved['host']) and user in (None, saved['user']):
+            host, user, password = saved['host'], saved['user'], saved['pass']
+    if not host or not user: raise BackupError(t['ERR_MISSING_HOST'])
+    if not password: raise BackupError(t['ERR_NO_PASSWORD'].format(env=config['password_env'], master_env=MASTER_PASSWORD_ENV_VAR))
+    return {'host': host, 'port': int(config['port']), 'user': user, 'pass': password}
+
+def resolve_rate(value, option, t):
+    """parse_rate per un'opzione dell'utente: un valore non valido (o negativo) diventa un BackupError
+    leggibile invece di un traceback a backup già iniziato."""
+    try:
+        rate = parse_rate(value)
+        if rate is not None and rate < 0: raise ValueError(value)
+    except (TypeError, ValueError):
+        raise BackupError(t['ERR_INVALID_RATE'].format(option=option, value=value)) from None
+    return rate
+
+def resolve_rate_options(config, t):
+    """Banda e comandi/s del sito e memoria dell'inventario, validati prima di connettersi."""
+    return tuple(resolve_rate(config[key], '--' + key.replace('_', '-'), t)
+                 for key in ('max_bandwidth', 'max_commands', 'inventory_memory'))
+
+def resolve_archive_options(config, t):
+    """Formato d'archivio (None per l'albero di cartelle, 'store' per lo store deduplicato) e password
+    di cifratura, validati prima di connettersi."""
+    archive_format = config['format']
+    if archive_format in ('dir', 'store') and config['encrypt']: raise BackupError(t['ERR_ENCRYPT_NEEDS_ARCHIVE'])
+    if archive_format == 'dir': return None, None
+    if archive_format not in ARCHIVE_FORMATS + ('store',):
+        raise BackupError(t['ERR_ARCHIVE_FORMAT'].format(format=archive_format, formats=', '.join(OUTPUT_FORMATS)))
+    if archive_format == 'tar.zst' and zstandard is None: raise BackupError(t['ERR_ZSTD_MISSING'])
+    if config['engine'] != 'threads': raise BackupError(t['ERR_ARCHIVE_ENGINE'])
+    if config['resume']: raise BackupError(t['ERR_ARCHIVE_RESUME'])
+    password = None
+    if config['encrypt']:
+        password = os.environ.get(ARCHIVE_PASSWORD_ENV_VAR) or os.environ.get(MASTER_PASSWORD_ENV_VAR)
+        if not password: raise BackupError(t['ERR_NO_ARCHIVE_PASSWORD'].format(env=ARCHIVE_PASSWORD_ENV_VAR, master_env=MASTER_PASSWORD_ENV_VAR))
+    return archive_format, password
+
+def run_backup(config, t=None, ftp_main=None, budget=None, bandwidth=None, limits=None, telemetry=None, manifest=None):
+    """Esegue un backup senza alcuna interazione: è il punto d'ingresso per cron/systemd e per chi
+    usa lo script come libreria. `config` usa le chiavi di DEFAULT_CONFIG; `ftp_main` è una
+    connessione già aperta (modalità interattiva). `budget` (ConnectionBudget), `bandwidth`
+    (TokenBucket), `limits` (HostLimits), `telemetry` (Telemetry) e, con lo store, `manifest`
+    (ManifestIndex) sono condivisi tra i siti di run_sites(). Ritorna un dizionario con il riepilogo e solleva BackupError per gli errori fatali."""
+    config = {**DEFAULT_CONFIG, **config}
+    t = t or STRINGS[config['lang']]
+    if telemetry is None and (config['metrics_file'] or config['prometheus_file']):
+        # File delle metriche chiusi (e Prometheus scritto) anche se il backup fallisce
+        telemetry = Telemetry(config['metrics_file'], config['prometheus_file'])
+        try: return run_backup(config, t, ftp_main, budget, bandwidth, limits, telemetry, manifest)
+        finally: telemetry.close()
+    run_started = time.monotonic()
+    # Con quiet niente barra né messaggi informativi: restano solo avvisi ed errori
+    say = (lambda *args, **kwargs: None) if config['quiet'] else print
+    archive_format, archive_password = resolve_archive_options(config, t)
+    site_bandwidth, site_commands, inventory_memory = resolve_rate_options(config, t)
+    previous_handler = None
+    if limits is None and (config['host_limits'] or config['limits_file']):
+        limits = HostLimits(config['host_limits'], config['limits_file'], t, config['quiet'])
+        previous_handler = limits.install_signal()
+    if ftp_main:
+        ftp_credentials = {'host': config['host'], 'port': int(config['port']), 'user': config['user'], 'pass': config['password']}
+    else:
+        ftp_credentials = resolve_credentials(config, t)
+    site = f"{ftp_credentials['user']}@{ftp_credentials['host']}"
+    label = config['name'] or site
+    metrics = telemetry.site(label) if telemetry else SiteMetrics(label)
+    if not ftp_main:
+        # Anche la connessione principale rientra nel budget; la libera discovery_worker chiudendola
+        if budget: budget.acquire(label, ftp_credentials['host'])
+        say(t['STATUS_CONNECTING'].format(host=ftp_credentials['host']))
+        started = time.monotonic()
+        ftp_main = connect_ftp(ftp_credentials['host'], ftp_credentials['user'], ftp_credentials['pass'], t, ftp_credentials['port'])
+        metrics.connected(time.monotonic() - started, bool(ftp_main))
+        metrics.phase('connect', time.monotonic() - started)
+        if not ftp_main:
+            if budget: budget.release(label, ftp_credentials['host'])
+            raise BackupError(t['ERR_CONNECTION_FAILED'].format(host=ftp_credentials['host']))
+        say(t['OK_CONNECTED'])
+    output_dir = os.path.abspath(config['output_dir'] or SCRIPT_DIR)
+    store_dir = os.path.abspath(config['store_dir'] or os.path.join(output_dir, STORE_DIR))
+    include, exclude = config['include'], config['exclude']
+
+    try:
+        if config['resume']:
+            # Ripresa: cartelle, filtri e destinazione vengono dal registro dell'esecuzione interrotta
+            local_backup_dir = os.path.abspath(config['resume'])
+            journal_path = os.path.join(local_backup_dir, JOURNAL_FILE)
+            journal = RunJournal(journal_path, resume=True) if os.path.exists(journal_path) else None
+            if not journal or not journal.header:
+                raise BackupError(t['ERR_RESUME_NO_JOURNAL'].format(path=local_backup_dir))
+            if journal.header['site'] != site:
+                raise BackupError(t['ERR_RESUME_HOST_MISMATCH'].format(expected=journal.header['site'], actual=site))
+            selected_dirs = journal.header['dirs']
+            include, exclude = journal.header.get('include', include), journal.header.get('exclude', exclude)
+            journal.write({'op': 'resume', 'at': datetime.now().isoformat(timespec='seconds')})
+            say(t['LBL_RESUMING'].format(path=local_backup_dir))
+        else:
+            if config['dirs']:
+                selected_dirs = [d.strip('/') for d in config['dirs']]
+                default_name = selected_dirs[0] if len(selected_dirs) == 1 else t['BACKUP_PART_MULTI']
+            else:
+                selected_dirs = get_remote_dirs(ftp_main, t, say)
+                if not selected_dirs: raise BackupError(t['ERR_NO_DIRS_FOUND'])
+                default_name = t['BACKUP_PART_FULL']
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            dynamic_name_part = (config['backup_name'] or default_name).replace('/', '_')
+            base_dir, counter = os.path.join(output_dir, f"{t['BACKUP_PREFIX']}_{dynamic_name_part}_{timestamp}"), 1
+            local_backup_dir = base_dir
+            # Con lo store la cartella del backup è solo la radice dei percorsi dello snapshot
+            if archive_format != 'store':
+                os.makedirs(output_dir, exist_ok=True)
+                # Due backup nello stesso secondo (o in parallelo) non devono condividere cartella e registro
+                while True:
+                    try:
+                        os.mkdir(local_backup_dir)
+                        break
+                    except FileExistsError:
+                        counter += 1
+                        local_backup_dir = f"{base_dir}_{counter}"
+            # Un archivio non si riprende a metà (i segmenti compressi non si riaprono): niente registro
+            journal = None
+            if not archive_format:
+                journal = RunJournal(os.path.join(local_backup_dir, JOURNAL_FILE))
+                journal.write({'op': 'run', 'site': site, 'dirs': selected_dirs, 'include': include, 'exclude': exclude,
+                               'started': datetime.now().isoformat(timespec='seconds')})
+    except BaseException:
+        try: ftp_main.quit()
+        except ftplib.all_errors: pass
+        finally:
+            if budget: budget.release(label, ftp_credentials['host'])
+        raise
+
+    # Un indice ricevuto da run_sites è condiviso con gli altri siti: lo chiude chi l'ha aperto
+    owns_manifest = manifest is None
+    # L'indice incrementale collega file del backup precedente (o blob dello store): un archivio è sempre completo
+    if manifest is None and config['incremental'] and archive_format in (None, 'store'):
+        try:
+            if archive_format: os.makedirs(store_dir, exist_ok=True)
+            manifest = ManifestIndex(os.path.join(store_dir if archive_format else output_dir, MANIFEST_DB_FILE))
+        except sqlite3.Error as e:
+            print(t['ERR_MANIFEST'].format(e=e))
+
+    num_workers = max(int(config['workers']), 1)
+    num_listers = max(int(config['discovery_connections']), 1)
+    # Le sessioni del pool servono prima alla scansione e poi ai download (al massimo una per operaio
+    # o lister). Con il motore a thread almeno una resta agli operai mentre la scansione è in corso,
+    # altrimenti nessun download parte prima della fine della scansione
+    max_sessions = max(num_workers, num_listers)
+    if config['engine'] == 'threads':
+        max_sessions = max(max_sessions, 2)
+        num_listers = min(num_listers, max_sessions - 1)
+    # Scansione e download procedono insieme: i file scoperti finiscono subito nella coda
+    say(t['STATUS_DISCOVERY_DOWNLOAD'].format(listers=num_listers))
+    say(t['STATUS_ENGINE'].format(engine=config['engine'], workers=num_workers))
+    archive = None
+    if archive_format == 'store':
+        archive = BlobStore(store_dir, local_backup_dir, label, {'snapshot': os.path.basename(local_backup_dir), 'site': site,
+                                                                'dirs': selected_dirs, 'started': datetime.now().isoformat(timespec='seconds')})
+    elif archive_format:
+        archive = BackupArchive(local_backup_dir, archive_format, archive_password)
+    verifier = None
+    if config['verify']:
+        command, algorithm = detect_server_hash(ftp_main)
+        if archive_format == 'store': report_path = archive.snapshot_path[:-len(SNAPSHOT_SUFFIX)] + VERIFY_REPORT_SUFFIX
+        else: report_path = os.path.join(local_backup_dir, VERIFY_REPORT_FILE)
+        verifier = VerificationReport(report_path, site, command, algorithm)
+        if command: say(t['STATUS_VERIFY_SERVER'].format(algorithm=algorithm, command=command))
+        else: say(t['STATUS_VERIFY_LOCAL'].format(algorithm=algorithm))
+    pbar_overall = tqdm(total=0, unit='B', unit_scale=True, desc=t['TQDM_TOTAL_DISCOVERING'], disable=config['quiet'])
+
+    def on_adjust(active, total, reason):
+        if config['quiet']: return
+        reason_text = t['LBL_REASON_SERVER_ERRORS'] if reason == 'errors' else t['LBL_REASON_THROUGHPUT']
+        with tqdm_lock: tqdm.write(t['LBL_WORKERS_ADJUSTED'].format(active=active, total=total, reason=reason_text))
+
+    host_bandwidth, host_commands = limits.buckets_for(ftp_credentials['host']) if limits else (None, None)
+    buckets = [bandwidth, TokenBucket(site_bandwidth) if site_bandwidth else None, host_bandwidth]
+    commands = [TokenBucket(site_commands) if site_commands else None, host_commands]
+    # Le sessioni della scansione passano poi ai download: al massimo una sessione per operaio (o lister)
+    inventory = FileInventory(inventory_memory, output_dir)
+    run = BackupRun(ftp_credentials, t, WorkScheduler(num_workers, on_adjust, inventory), pbar_overall, manifest, journal, include, exclude,
+                    label, budget, buckets, max_sessions, archive, verifier, commands, limits, metrics)
+
+    if config['engine'] == 'asyncio':
+        # Un solo thread con l'event loop che gestisce tutte le connessioni
+        threads = [threading.Thread(target=run_async_engine, args=(run, num_workers), daemon=True)]
+    else:
+        threads = [threading.Thread(target=download_worker, args=(run, worker_id), daemon=True) for worker_id in range(num_workers)]
+    download_started = time.monotonic()
+    for thread in threads: thread.start()
+
+    roots = [(f"/{dir_name}", os.path.join(local_backup_dir, dir_name)) for dir_name in selected_dirs]
+    stats = discover_files_parallel(ftp_main, roots, run, num_listers)
+    metrics.phase('discovery', time.monotonic() - download_started)
+    # Il motore asyncio usa connessioni proprie: le sessioni della scansione non servono più
+    if config['engine'] == 'asyncio': run.pool.close()
+
+    with tqdm_lock:
+        pbar_overall.set_description(t['TQDM_TOTAL_BACKUP'])
+        if not config['quiet']:
+            tqdm.write(t['LBL_DISCOVERY_SUMMARY'].format(file_count=stats.file_count, dir_count=stats.dir_count))
+            if stats.unchanged_count:
+                tqdm.write(t['LBL_INCREMENTAL_SUMMARY'].format(count=stats.unchanged_count, size=tqdm.format_sizeof(stats.unchanged_size, 'B')))
+            if stats.already_done_count:
+                tqdm.write(t['LBL_RESUME_SUMMARY'].format(count=stats.already_done_count))
 
-def main():
-    """Funzione principale che orchestra l'intero processo."""
-    lang_choice = ""
+    # Scansione finita: gli operai escono appena lo scheduler si svuota
+    run.scheduler.close()
+    for thread in threads: thread.join()
+    # Scansione e download si sovrappongono: 'download' va dall'avvio degli operai all'ultimo file
+    metrics.phase('download', time.monotonic() - download_started)
+    finalize_started = time.monotonic()
+    run.pool.close()
+    # Operai arresi per server irraggiungibile: i file rimasti contano come falliti, non spariscono
+    for item in run.scheduler.drain(): run.report_failure(item[0], t['ERR_NO_CONNECTION'])
+    pbar_overall.close()
+    if previous_handler is not None: signal.signal(signal.SIGHUP, previous_handler)
+    if verifier: verifier.close()
+    if manifest and owns_manifest: manifest.close()
+    if journal: journal.close()
+    if archive: archive.close()
+    if archive_format == 'store':
+        local_backup_dir = archive.snapshot_path
+        say(t['LBL_STORE_SUMMARY'].format(new=archive.new_blobs, new_size=tqdm.format_sizeof(archive.new_size, 'B'),
+                                          dedup=archive.deduplicated, dedup_size=tqdm.format_sizeof(archive.deduplicated_size, 'B')))
+    elif archive:
+        say(t['LBL_ARCHIVE_SEGMENTS'].format(count=len(archive.segments), format=archive_format + ('.enc' if archive_password else '')))
+
+    metrics.phase('finalize', time.monotonic() - finalize_started)
+    metrics.phase('total', time.monotonic() - run_started)
+    summary = metrics.summary()
+    say(t['LBL_METRICS_SUMMARY'].format(
+        discovery=summary['phases']['discovery'], download=summary['phases']['download'], total=summary['phases']['total'],
+        connect=summary['connect_mean_seconds'] * 1000, mlsd=summary['mlsd_mean_seconds'] * 1000,
+        mlsd_max=summary['mlsd_max_seconds'] * 1000, throughput=tqdm.format_sizeof(summary['throughput_bytes_per_second'], 'B')))
+    if verifier:
+        say(t['LBL_VERIFY_SUMMARY'].format(verified=verifier.verified, server=verifier.server_verified,
+                                           mismatches=verifier.mismatches, path=verifier.filepath))
+    if stats.failed_count: print(f"{Colors.YELLOW}{t['LBL_FAILED_SUMMARY'].format(count=stats.failed_count)}{Colors.RESET}")
+    say(t['LBL_CONNECTION_SUMMARY'].format(logins=run.pool.logins, reused=run.pool.reused, dropped=run.pool.dropped,
+                                           retried=stats.retried_count))
+    say(t['LBL_BACKUP_COMPLETE'])
+    say(t['LBL_FILES_SAVED_TO'].format(path=local_backup_dir))
+    result = {
+        'site': site, 'name': label, 'backup_dir': local_backup_dir,
+        'files': stats.file_count, 'dirs': stats.dir_count, 'bytes': stats.total_size,
+        'unchanged': stats.unchanged_count, 'already_done': stats.already_done_count, 'failed': stats.failed_count,
+        'retried': stats.retried_count, 'logins': run.pool.logins,
+        'verified': verifier.verified if verifier else 0, 'mismatches': verifier.mismatches if verifier else 0,
+        'metrics': summary,
+    }
+    if telemetry: telemetry.finish_site(metrics, result)
+    return result
+
+def run_sites(sites_config, t=None, path='sites'):
+    """Backup di più siti in parallelo nello stesso processo, con un tetto globale di connessioni
+    (`max_connections`), uno per host (`max_connections_per_host`), una banda totale (`max_bandwidth`)
+    e limiti di byte/s e comandi/s per host (`host_limits`, `limits_file`) condivisi tra i siti.
+    Con `metrics_file`/`prometheus_file` le metriche di tutti i siti finiscono negli stessi file.
+    `sites_config` = {'defaults': {...}, 'sites': [{...}, ...]} con le chiavi di DEFAULT_CONFIG;
+    ogni sito salva in una propria sottocartella di output_dir. Ritorna un risultato per sito
+    (quello di run_backup, oppure {'name', 'error'} se il sito è fallito)."""
+    defaults = {**DEFAULT_CONFIG, **sites_config.get('defaults', {})}
+    t = t or STRINGS[defaults['lang']]
+    sites = sites_config.get('sites') or []
+    if not sites: raise BackupError(t['ERR_NO_SITES'].format(path=path))
+    max_connections = int(sites_config.get('max_connections') or MAX_TOTAL_CONNECTIONS)
+    budget = ConnectionBudget(max_connections, sites_config.get('max_connections_per_host'))
+    total_bandwidth = resolve_rate(sites_config.get('max_bandwidth'), '--max-bandwidth', t)
+    bandwidth = TokenBucket(total_bandwidth) if total_bandwidth else None
+    limits = None
+    if sites_config.get('host_limits') or sites_config.get('limits_file'):
+        limits = HostLimits(sites_config.get('host_limits'), sites_config.get('limits_file'), t, defaults['quiet'])
+    telemetry = None
+    metrics_file = sites_config.get('metrics_file') or defaults['metrics_file']
+    prometheus_file = sites_config.get('prometheus_file') or defaults['prometheus_file']
+    if metrics_file or prometheus_file: telemetry = Telemetry(metrics_file, prometheus_file)
+    base_dir = os.path.abspath(defaults['output_dir'] or SCRIPT_DIR)
+
+    configs = []
+    for site in sites:
+        config = {**defaults, 'quiet': True, **site}
+        config['name'] = config['name'] or f"{config['user']}@{config['host']}"
+        if not site.get('output_dir'): config['output_dir'] = os.path.join(base_dir, config['name'].replace('/', '_'))
+        # Uno store unico per tutti i siti: i contenuti uguali tra siti diversi sono salvati una volta sola
+        config['store_dir'] = config['store_dir'] or os.path.join(base_dir, STORE_DIR)
+        configs.append(config)
+    # Un solo indice (una sola connessione SQLite) per store: connessioni diverse sullo stesso file
+    # si bloccherebbero a vicenda durante le transazioni di record_many()
+    manifests = {}
+    for config in configs:
+        if config['format'] == 'store' and config['incremental'] and config['store_dir'] not in manifests:
+            try:
+                os.makedirs(config['store_dir'], exist_ok=True)
+                manifests[config['store_dir']] = ManifestIndex(os.path.join(config['store_dir'], MANIFEST_DB_FILE))
+            except (OSError, sqlite3.Error) as e:
+                print(t['ERR_MANIFEST'].format(e=e))
+    # Tutti i siti sono registrati prima di partire, così la quota equa vale da subito
+    for config in configs: budget.register(config['name'])
+
+    print(t['STATUS_SITES'].format(count=len(configs), connections=max_connections))
+    results = [None] * len(configs)
+
+    def backup_site(index, config):
+        try:
+            results[index] = run_backup(config, t, budget=budget, bandwidth=bandwidth, limits=limits, telemetry=telemetry,
+                                        manifest=manifests.get(config['store_dir']) if config['format'] == 'store' else None)
+            result = results[index]
+            with tqdm_lock:
+                tqdm.write(t['LBL_SITE_DONE'].format(name=config['name'], files=result['files'], failed=result['failed'],
+                                                     size=tqdm.format_sizeof(result['bytes'], 'B'), path=result['backup_dir']))
+        except Exception as e:
+            results[index] = {'name': config['name'], 'error': str(e)}
+            with tqdm_lock:
+                tqdm.write(f"{Colors.RED}{t['LBL_SITE_FAILED'].format(name=config['name'], e=e)}{Colors.RESET}", file=sys.stderr)
+        finally:
+            budget.unregister(config['name'])
+
+    previous_handler = limits.install_signal() if limits else None
+    start = time.monotonic()
+    threads = [threading.Thread(target=backup_site, args=(index, config), daemon=True) for index, config in enumerate(configs)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if previous_handler is not None: signal.signal(signal.SIGHUP, previous_handler)
+    if telemetry: telemetry.close()
+    for manifest in manifests.values(): manifest.close()
+    ok = sum(1 for result in results if 'error' not in result)
+    print(t['LBL_SITES_SUMMARY'].format(ok=ok, total=len(results), elapsed=time.monotonic() - start))
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="FTP Backup Utility",
+        epilog="Senza --host/--config parte la modalità interattiva. / Without --host/--config the interactive mode starts.\n"
+               f"Password: variabile {PASSWORD_ENV_VAR}, --password-file, oppure credentials.enc + {MASTER_PASSWORD_ENV_VAR}.",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', metavar='FILE', help="file JSON con le opzioni (stesse chiavi dei parametri) / JSON config file")
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--user')
+    parser.add_argument('--password-env', metavar='VAR', help=f"variabile d'ambiente con la password (default: {PASSWORD_ENV_VAR})")
+    parser.add_argument('--password-file', metavar='FILE', help="file che contiene la password FTP / file holding the FTP password")
+    parser.add_argument('--dirs', help="cartelle separate da virgola (default: tutte) / comma-separated folders (default: all)")
+    parser.add_argument('--include', action='append', metavar='GLOB', help="salva solo i file che corrispondono / only back up matching files")
+    parser.add_argument('--exclude', action='append', metavar='GLOB', help="ignora file e cartelle che corrispondono / skip matching files and folders")
+    parser.add_argument('--workers', type=int, help=f"connessioni di download (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--discovery-connections', type=int, help=f"connessioni di scansione (default: {DISCOVERY_CONNECTIONS})")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                        help="motore di download / download engine (default: threads)")
+    parser.add_argument('--output-dir', metavar='DIR', help="dove creare i backup (default: cartella dello script)")
+    parser.add_argument('--no-incremental', dest='incremental', action='store_false', default=None,
+                        help="riscarica tutto ignorando l'indice / ignore the manifest and download everything")
+    parser.add_argument('--resume', metavar='BACKUP_DIR',
+                        help="riprende un backup interrotto / resume an interrupted backup")
+    parser.add_argument('--no-verify', dest='verify', action='store_false', default=None,
+                        help="niente hash né confronto con il server (resta il controllo delle dimensioni) / skip hashing")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help="albero di cartelle (default), archivio in streaming o store deduplicato / folder tree (default), streamed archive or deduplicated store")
+    parser.add_argument('--store-dir', metavar='DIR', help="cartella dello store (default: <output-dir>/store) / store folder")
+    parser.add_argument('--restore', metavar='SNAPSHOT', help="ripristina uno snapshot dello store e termina / restore a store snapshot and exit")
+    parser.add_argument('--restore-to', metavar='DIR', help="con --restore: cartella di destinazione / with --restore: destination folder")
+    parser.add_argument('--prune', action='store_true', help="applica la politica di conservazione allo store e termina / prune the store and exit")
+    parser.add_argument('--keep-last', type=int, metavar='N', help="con --prune: ultimi N snapshot per sito / keep the last N snapshots per site")
+    parser.add_argument('--keep-days', type=int, metavar='N', help="con --prune: snapshot degli ultimi N giorni / keep snapshots from the last N days")
+    parser.add_argument('--encrypt', action='store_true', default=None,
+                        help=f"archivio cifrato con la password in {ARCHIVE_PASSWORD_ENV_VAR} / encrypted archive")
+    parser.add_argument('--decrypt', metavar='ARCHIVE', help="decifra un archivio .enc e termina / decrypt an .enc archive and exit")
+    parser.add_argument('--sites', metavar='FILE',
+                        help="file JSON con più siti da salvare in parallelo / JSON file with several sites to back up in parallel")
+    parser.add_argument('--max-connections', type=int,
+                        help=f"con --sites: connessioni totali (default: {MAX_TOTAL_CONNECTIONS}) / total connections")
+    parser.add_argument('--max-connections-per-host', type=int, help="con --sites: connessioni per host / connections per host")
+    parser.add_argument('--max-bandwidth', metavar='RATE',
+                        help="banda massima, es. 50M (con --sites: totale di tutti i siti) / bandwidth limit, e.g. 50M (with --sites: total)")
+    parser.add_argument('--max-commands', type=float, metavar='N', help="comandi al secondo per sito / commands per second per site")
+    parser.add_argument('--limits', metavar='FILE',
+                        help="limiti per host (JSON), riletto quando cambia o con SIGHUP / per-host limits, reloaded on change or SIGHUP")
+    parser.add_argument('--inventory-memory', metavar='SIZE',
+                        help="memoria per l'elenco dei file in attesa, es. 64M; oltre si usa il disco / memory for pending files before spilling to disk")
+    parser.add_argument('--metrics', metavar='FILE', help="eventi e tempi in JSON lines / timings and events as JSON lines")
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help="metriche per il textfile collector di node_exporter / metrics for the node_exporter textfile collector")
+    parser.add_argument('--lang', choices=['it', 'en'])
+    parser.add_argument('--quiet', action='store_true', default=None,
+                        help="nessuna barra né messaggi informativi / no progress bar or informational output")
+    return parser.parse_args(argv)
+
+def config_from_args(args, t):
+    """Unisce file di configurazione e opzioni della riga di comando (queste ultime hanno la precedenza)."""
+    config = load_config_file(args.config, t) if args.config else {}
+    overrides = {
+        'host': args.host, 'port': args.port, 'user': args.user, 'password_env': args.password_env,
+        'password_file': args.password_file, 'include': args.include, 'exclude': args.exclude,
+        'workers': args.workers, 'discovery_connections': args.discovery_connections, 'engine': args.engine,
+        'output_dir': args.output_dir, 'incremental': args.incremental, 'resume': args.resume,
+        'lang': args.lang, 'quiet': args.quiet, 'format': args.format, 'encrypt': args.encrypt, 'store_dir': args.store_dir,
+        'verify': args.verify, 'max_bandwidth': args.max_bandwidth, 'max_commands': args.max_commands, 'limits_file': args.limits,
+        'metrics_file': args.metrics, 'prometheus_file': args.prometheus, 'inventory_memory': args.inventory_memory,
+        'dirs': [d.strip() for d in args.dirs.split(',') if d.strip()] if args.dirs else None,
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    return config
+
+def main(argv=None):
+    """Funzione principale: con --sites salva più siti in parallelo, con --host o --config esegue un
+    backup non interattivo (cron/systemd), altrimenti guida l'utente con le domande di sempre."""
+    args = parse_args(argv)
+    if args.decrypt:
+        t = STRINGS[args.lang or 'en']
+        destination = args.decrypt[:-len('.enc')] if args.decrypt.endswith('.enc') else args.decrypt + '.dec'
+        if os.path.exists(destination):
+            print(f"{Colors.RED}{t['ERR_DECRYPT_ARCHIVE'].format(path=args.decrypt, e=FileExistsError(destination))}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        password = os.environ.get(ARCHIVE_PASSWORD_ENV_VAR) or os.environ.get(MASTER_PASSWORD_ENV_VAR) or getpass.getpass(t['PROMPT_ARCHIVE_PASS'])
+        try:
+            decrypt_archive(args.decrypt, destination, password)
+        except (OSError, ValueError) as e:
+            if os.path.exists(destination): os.remove(destination)
+            print(f"{Colors.RED}{t['ERR_DECRYPT_ARCHIVE'].format(path=args.decrypt, e=e)}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        print(t['OK_ARCHIVE_DECRYPTED'].format(path=destination))
+        sys.exit(0)
+    if args.restore:
+        t = STRINGS[args.lang or 'en']
+        name = os.path.basename(args.restore)[:-len(SNAPSHOT_SUFFIX)] if args.restore.endswith(SNAPSHOT_SUFFIX) else os.path.basename(args.restore)
+        destination = os.path.abspath(args.restore_to or os.path.join(os.getcwd(), name))
+        if os.path.exists(destination) and os.listdir(destination):
+            print(f"{Colors.RED}{t['ERR_RESTORE'].format(path=args.restore, e=FileExistsError(destination))}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        try:
+            files, size = restore_snapshot(args.restore, destination)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"{Colors.RED}{t['ERR_RESTORE'].format(path=args.restore, e=e)}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        print(t['OK_RESTORED'].format(files=files, size=tqdm.format_sizeof(size, 'B'), path=destination))
+        sys.exit(0)
+    if args.prune:
+        t = STRINGS[args.lang or 'en']
+        if args.keep_last is None and args.keep_days is None:
+            print(f"{Colors.RED}{t['ERR_PRUNE_POLICY']}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        store_dir = os.path.abspath(args.store_dir or os.path.join(args.output_dir or SCRIPT_DIR, STORE_DIR))
+        try:
+            snapshots, blobs, freed = prune_store(store_dir, args.keep_last, args.keep_days)
+        except StoreBusyError as e:
+            print(f"{Colors.RED}{t['ERR_STORE_BUSY'].format(path=e)}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        print(t['OK_PRUNED'].format(snapshots=snapshots, blobs=blobs, size=tqdm.format_sizeof(freed, 'B')))
+        sys.exit(0)
+    if args.sites:
+        t = STRINGS[args.lang or 'en']
+        try:
+            sites_config = load_config_file(args.sites, t)
+            overrides = {'max_connections': args.max_connections, 'max_connections_per_host': args.max_connections_per_host,
+                         'max_bandwidth': args.max_bandwidth, 'limits_file': args.limits,
+                         'metrics_file': args.metrics, 'prometheus_file': args.prometheus}
+            sites_config.update({key: value for key, value in overrides.items() if value is not None})
+            defaults = sites_config.setdefault('defaults', {})
+            if args.lang: defaults['lang'] = args.lang
+            if args.quiet: defaults['quiet'] = True
+            if args.output_dir: defaults['output_dir'] = args.output_dir
+            if args.engine: defaults['engine'] = args.engine
+            if args.workers: defaults['workers'] = args.workers
+            if args.format: defaults['format'] = args.format
+            if args.store_dir: defaults['store_dir'] = args.store_dir
+            if args.verify is not None: defaults['verify'] = args.verify
+            if args.max_commands: defaults['max_commands'] = args.max_commands
+            if args.inventory_memory: defaults['inventory_memory'] = args.inventory_memory
+            results = run_sites(sites_config, STRINGS[defaults.get('lang', 'en')], args.sites)
+        except BackupError as e:
+            print(f"{Colors.RED}{e}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        # 1: almeno un sito fallito, 2: tutti completati ma con file mancanti
+        if any('error' in result for result in results): sys.exit(1)
+        sys.exit(2 if any(result['failed'] for result in results) else 0)
+    if args.config or args.host:
+        t = STRINGS[args.lang or 'en']
+        try:
+            config = config_from_args(args, t)
+            result = run_backup(config, STRINGS[config.get('lang', 'en')])
+        except BackupError as e:
+            print(f"{Colors.RED}{e}{Colors.RESET}", file=sys.stderr)
+            sys.exit(1)
+        # Codice d'uscita 2: backup completato ma con file mancanti
+        sys.exit(2 if result['failed'] else 0)
+
+    lang_choice = args.lang or ""
     while lang_choice not in ['it', 'en']:
         lang_choice = input("Scegli la lingua / Choose language (it/en): ").lower().strip()
     t = STRINGS[lang_choice]
 
     print(t['APP_TITLE'])
-    
+
+    if args.resume:
+        resume_dir = os.path.abspath(args.resume)
+        if not os.path.exists(os.path.join(resume_dir, JOURNAL_FILE)):
+            print(f"{Colors.RED}{t['ERR_RESUME_NO_JOURNAL'].format(path=resume_dir)}{Colors.RESET}")
+            sys.exit(1)
+
     cred_manager = CredentialsManager(os.path.join(SCRIPT_DIR, ENCRYPTED_CREDS_FILE))
     plaintext_creds_path = os.path.join(SCRIPT_DIR, PLAINTEXT_CREDS_FILE)
     ftp_credentials = None
@@ -306,18 +3134,23 @@ def main():
             'pass': getpass.getpass(t['PROMPT_PASS'])
         }
 
-    num_threads_input = input(t['PROMPT_THREADS'])
-    try:
-        num_threads = int(num_threads_input)
-        if num_threads <= 0:
-            print(t['ERR_INVALID_NUMBER'])
-            num_threads = 15
-    except ValueError:
-        if num_threads_input != "": print(t['ERR_NOT_NUMERIC'])
-        num_threads = 15
+    if args.workers:
+        num_threads = args.workers
+    else:
+        num_threads_input = input(t['PROMPT_THREADS'])
+        try:
+            num_threads = int(num_threads_input)
+            if num_threads <= 0:
+                print(t['ERR_INVALID_NUMBER'])
+                num_threads = DEFAULT_WORKERS
+        except ValueError:
+            if num_threads_input != "": print(t['ERR_NOT_NUMERIC'])
+            num_threads = DEFAULT_WORKERS
 
+    # --port vale anche in modalità interattiva
+    port = args.port or ftp_credentials.get('port', 21)
     print(t['STATUS_CONNECTING'].format(host=ftp_credentials['host']))
-    ftp_main = connect_ftp(ftp_credentials['host'], ftp_credentials['user'], ftp_credentials['pass'], t)
+    ftp_main = connect_ftp(ftp_credentials['host'], ftp_credentials['user'], ftp_credentials['pass'], t, port)
     
     if not ftp_main: sys.exit(1)
     print(t['OK_CONNECTED'])
@@ -350,84 +3183,43 @@ def main():
                     except Exception as e:
                         print(f"❌ Errore durante il salvataggio in chiaro: {e}")
 
-    available_dirs = get_remote_dirs(ftp_main, t)
-    if not available_dirs:
-        print(t['ERR_NO_DIRS_FOUND'])
-        ftp_main.quit()
-        return
+    config = config_from_args(args, t)
+    config.update({'host': ftp_credentials['host'], 'port': port, 'user': ftp_credentials['user'],
+                   'password': ftp_credentials['pass'], 'workers': num_threads, 'lang': lang_choice})
+    if not args.resume:
+        available_dirs = get_remote_dirs(ftp_main, t)
+        if not available_dirs:
+            print(t['ERR_NO_DIRS_FOUND'])
+            ftp_main.quit()
+            return
 
-    print(t['LBL_AVAILABLE_DIRS'])
-    for i, dir_name in enumerate(available_dirs): print(f"  [{i + 1}] {dir_name}")
-    print("------------------------------------------")
-    selected_dirs, user_choice_raw = [], ""
-    while True:
-        try:
-            user_choice_raw = input(t['PROMPT_DIRS'])
-            choice = user_choice_raw.strip().lower()
-            if choice == t['CHOICE_ALL']:
-                selected_dirs = available_dirs
-                break
-            else:
-                indices = [int(i.strip()) for i in choice.split(',')]
-            if all(1 <= i <= len(available_dirs) for i in indices):
-                selected_dirs = [available_dirs[i - 1] for i in indices]
-                break
-            else: print(t['ERR_INVALID_INPUT'])
-        except ValueError: print(t['ERR_INVALID_INPUT'])
-
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    if user_choice_raw.strip().lower() == t['CHOICE_ALL']: dynamic_name_part = t['BACKUP_PART_FULL']
-    elif len(selected_dirs) == 1: dynamic_name_part = selected_dirs[0]
-    else: dynamic_name_part = t['BACKUP_PART_MULTI']
-    timestamped_folder_name = f"{t['BACKUP_PREFIX']}_{dynamic_name_part}_{timestamp}"
-    local_backup_dir = os.path.join(SCRIPT_DIR, timestamped_folder_name)
-
-    stop_spinner_event = threading.Event()
-    spinner_thread = threading.Thread(target=animate_discovery, args=(stop_spinner_event, t))
-    spinner_thread.daemon = True
-    spinner_thread.start()
-
-    files_to_download = []
-    for dir_name in selected_dirs:
-        remote_path, local_path = f"/{dir_name}", os.path.join(local_backup_dir, dir_name)
-        discover_files_recursive(ftp_main, remote_path, local_path, files_to_download, t)
-    
-    stop_spinner_event.set()
-    spinner_thread.join()
-    ftp_main.quit()
-    
-    # --- NUOVA SEZIONE: Calcolo e Stampa del Riepilogo ---
-    file_count = len(files_to_download)
-    # Crea un set di percorsi di directory unici da tutti i file trovati
-    unique_dirs = set(os.path.dirname(local_path) for _, local_path, _ in files_to_download)
-    dir_count = len(unique_dirs)
-    
-    print(t['LBL_DISCOVERY_SUMMARY'].format(file_count=file_count, dir_count=dir_count))
-    # --- FINE NUOVA SEZIONE ---
-
-    if not files_to_download:
-        print(t['LBL_BACKUP_COMPLETE'])
-        return
-
-    print(t['LBL_DOWNLOAD_START'])
-    
-    work_queue = Queue()
-    for file_info in files_to_download: work_queue.put(file_info)
-
-    total_backup_size = sum(size for _, _, size in files_to_download)
-    pbar_overall = tqdm(total=total_backup_size, unit='B', unit_scale=True, desc=t['TQDM_TOTAL_BACKUP'])
-    
-    threads = []
-    for _ in range(num_threads):
-        thread = threading.Thread(target=download_worker, args=(work_queue, pbar_overall, ftp_credentials, t), daemon=True)
-        thread.start()
-        threads.append(thread)
+        print(t['LBL_AVAILABLE_DIRS'])
+        for i, dir_name in enumerate(available_dirs): print(f"  [{i + 1}] {dir_name}")
+        print("------------------------------------------")
+        selected_dirs, user_choice_raw = [], ""
+        while True:
+            try:
+                user_choice_raw = input(t['PROMPT_DIRS'])
+                choice = user_choice_raw.strip().lower()
+                if choice == t['CHOICE_ALL']:
+                    selected_dirs = available_dirs
+                    break
+                else:
+                    indices = [int(i.strip()) for i in choice.split(',')]
+                if all(1 <= i <= len(available_dirs) for i in indices):
+                    selected_dirs = [available_dirs[i - 1] for i in indices]
+                    break
+                else: print(t['ERR_INVALID_INPUT'])
+            except ValueError: print(t['ERR_INVALID_INPUT'])
 
-    work_queue.join()
-    pbar_overall.close()
+        config['dirs'] = selected_dirs
+        if user_choice_raw.strip().lower() == t['CHOICE_ALL']: config['backup_name'] = t['BACKUP_PART_FULL']
 
-    print(t['LBL_BACKUP_COMPLETE'])
-    print(t['LBL_FILES_SAVED_TO'].format(path=local_backup_dir))
+    try:
+        run_backup(config, t, ftp_main)
+    except BackupError as e:
+        print(f"{Colors.RED}{e}{Colors.RESET}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
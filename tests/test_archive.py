@@ -0,0 +1,75 @@
+"""Archivi in streaming: cifratura AES-GCM a blocchi (EncryptedWriter) e segmenti zip."""
+import os
+import sys
+import warnings
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ftp_backup
+
+PASSWORD = "correct horse"
+CHUNK = ftp_backup.ARCHIVE_CHUNK_SIZE
+HEADER = len(ftp_backup.EncryptedWriter.MAGIC) + 24
+
+
+def encrypt(tmp_path, data, pieces=7):
+    """Scrive `data` in `pieces` pezzi di dimensione irregolare; ritorna il percorso del file cifrato."""
+    path = tmp_path / 'part-00.tar.enc'
+    with open(path, 'wb') as raw:
+        writer = ftp_backup.EncryptedWriter(raw, PASSWORD)
+        step = len(data) // pieces + 1
+        for start in range(0, len(data), step): writer.write(data[start:start + step])
+        writer.close()
+    return path
+
+
+def decrypt(tmp_path, path, password=PASSWORD):
+    destination = tmp_path / 'plain'
+    ftp_backup.decrypt_archive(str(path), str(destination), password)
+    return destination.read_bytes()
+
+
+@pytest.mark.parametrize('size', [0, 100, CHUNK, 2 * CHUNK + 12345])
+def test_round_trip(tmp_path, size):
+    data = os.urandom(size)
+    assert decrypt(tmp_path, encrypt(tmp_path, data)) == data
+
+
+def test_tampered_tag_is_rejected(tmp_path):
+    path = encrypt(tmp_path, os.urandom(CHUNK + 10))
+    sealed = bytearray(path.read_bytes())
+    sealed[HEADER + 5 + CHUNK + 15] ^= 1  # Ultimo byte del tag del primo blocco
+    path.write_bytes(bytes(sealed))
+    with pytest.raises(ValueError):
+        decrypt(tmp_path, path)
+
+
+def test_truncated_archive_is_rejected(tmp_path):
+    path = encrypt(tmp_path, os.urandom(CHUNK + 10))
+    # Senza il blocco finale l'archivio non risulta completo
+    path.write_bytes(path.read_bytes()[:HEADER + 5 + CHUNK + 16])
+    with pytest.raises(ValueError):
+        decrypt(tmp_path, path)
+
+
+def test_wrong_password_is_rejected(tmp_path):
+    path = encrypt(tmp_path, b'data')
+    with pytest.raises(ValueError):
+        decrypt(tmp_path, path, 'wrong')
+
+
+def test_zip_duplicate_member_leaves_warning_filters_alone(tmp_path):
+    filters = list(warnings.filters)
+    segment = ftp_backup.ArchiveSegment(str(tmp_path / 'part-00.zip'), 'zip')
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        segment.add_file('a.txt', b'first', 0)
+        segment.add_file('a.txt', b'retry', 0)
+    segment.close()
+    assert not caught
+    assert warnings.filters == filters
+    with zipfile.ZipFile(tmp_path / 'part-00.zip') as archive:
+        assert archive.read('a.txt') == b'retry'
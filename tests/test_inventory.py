@@ -0,0 +1,59 @@
+"""FileInventory: record compatti per classe di dimensione, con i blocchi oltre il limite su disco."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ftp_backup
+
+SIZES = [0, 1, 700, 4096, 5000, 2 ** 20 + 3, 3 * 2 ** 30, None]
+
+
+def make_items(count):
+    items = []
+    for i in range(count):
+        remote_dir = f"/site/d{i % 37}/sub{i % 5}"
+        name = f"file_{i}_è.txt"
+        # Ogni tanto il nome locale differisce da quello remoto
+        local_name = name if i % 11 else f"renamed_{i}.txt"
+        items.append((f"{remote_dir}/{name}", os.path.join("/backup", remote_dir.strip('/'), local_name),
+                      SIZES[i % len(SIZES)], f"2024010{i % 9}120000"))
+    return items
+
+
+def expected_order(items):
+    """Classe di dimensione più grande per prima, in ordine di scoperta dentro ogni classe."""
+    def bucket(item):
+        size = ftp_backup.FileInventory.UNKNOWN_SIZE if item[2] is None else item[2]
+        return min(size.bit_length(), 64)
+    return sorted(items, key=bucket, reverse=True)
+
+
+def test_spill_to_disk_round_trip(tmp_path):
+    items = make_items(60000)
+    inventory = ftp_backup.FileInventory(ftp_backup.INVENTORY_CHUNK_SIZE, str(tmp_path))
+    for item in items: inventory.put(item)
+    assert inventory.spill is not None and inventory.spill_size > 0
+    assert inventory.in_memory <= ftp_backup.INVENTORY_CHUNK_SIZE
+    assert len(inventory) == len(items)
+    popped = []
+    while len(inventory):
+        size = inventory.peek_size()
+        item = inventory.pop()
+        assert size == (ftp_backup.FileInventory.UNKNOWN_SIZE if item[2] is None else item[2])
+        popped.append(item)
+    assert popped == expected_order(items)
+    assert inventory.in_memory == 0
+    inventory.close()
+
+
+def test_interleaved_put_and_pop(tmp_path):
+    items = make_items(20000)
+    inventory = ftp_backup.FileInventory(0, str(tmp_path))  # Ogni blocco chiuso finisce su disco
+    popped = []
+    for start in range(0, len(items), 5000):
+        for item in items[start:start + 5000]: inventory.put(item)
+        popped += [inventory.pop() for _ in range(1000)]
+    popped += inventory.drain()
+    assert sorted(popped) == sorted(items)
+    assert len(inventory) == 0 and inventory.spill is None
@@ -0,0 +1,46 @@
+"""RunJournal: punto di ripresa (REST) di un file grande lasciato a metà."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ftp_backup
+
+MB = 1024 ** 2
+SIZE, MODIFY = 8 * MB, '20240101120000'
+
+
+def interrupted_run(tmp_path, written=3 * MB):
+    """Registro di un'esecuzione interrotta dopo `written` byte di /big.bin (file preallocato)."""
+    local = tmp_path / 'big.bin'
+    local.write_bytes(b'\0' * SIZE)
+    journal = ftp_backup.RunJournal(str(tmp_path / ftp_backup.JOURNAL_FILE))
+    journal.begin('/big.bin', SIZE, MODIFY, 0)
+    journal.checkpoint('/big.bin', written)
+    journal.close()
+    return ftp_backup.RunJournal(str(tmp_path / ftp_backup.JOURNAL_FILE), resume=True), str(local)
+
+
+def test_resume_from_checkpoint(tmp_path):
+    journal, local = interrupted_run(tmp_path)
+    assert journal.resume_offset('/big.bin', local, SIZE, MODIFY) == 3 * MB
+
+
+def test_changed_remote_file_restarts(tmp_path):
+    journal, local = interrupted_run(tmp_path)
+    assert journal.resume_offset('/big.bin', local, 10 * MB, MODIFY) == 0
+    assert journal.resume_offset('/big.bin', local, SIZE, '20240102120000') == 0
+
+
+def test_file_not_begun_restarts(tmp_path):
+    # Es. un collegamento al backup precedente: non va mai riaperto per scriverci
+    journal, _ = interrupted_run(tmp_path)
+    other = tmp_path / 'other.bin'
+    other.write_bytes(b'x' * MB)
+    assert journal.resume_offset('/other.bin', str(other), 2 * MB, MODIFY) == 0
+
+
+def test_done_file_restarts(tmp_path):
+    journal, local = interrupted_run(tmp_path)
+    journal.mark_done('/big.bin', SIZE)
+    assert journal.resume_offset('/big.bin', local, SIZE, MODIFY) == 0
@@ -0,0 +1,36 @@
+"""parse_rate: limiti di banda scritti come '10M', '10MB/s', 512K, ecc."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ftp_backup
+
+MB = 1024 ** 2
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    (1000, 1000),
+    (2.5, 2.5),
+    ('1000', 1000),
+    ('512K', 512 * 1024),
+    ('512k', 512 * 1024),
+    ('10M', 10 * MB),
+    ('10MB', 10 * MB),
+    ('10M/s', 10 * MB),
+    ('10MB/s', 10 * MB),
+    (' 10mb/s ', 10 * MB),
+    ('1.5G', 1.5 * 1024 ** 3),
+    ('100B/s', 100),
+    ('100/s', 100),
+])
+def test_parse_rate(value, expected):
+    assert ftp_backup.parse_rate(value) == expected
+
+
+def test_parse_rate_rejects_garbage():
+    with pytest.raises(ValueError):
+        ftp_backup.parse_rate('fast')
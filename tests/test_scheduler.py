@@ -0,0 +1,59 @@
+"""Adattamento del numero di operai attivi di WorkScheduler (AIMD)."""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ftp_backup
+
+
+def run_windows(scheduler, rate_for_limit, windows):
+    """Simula `windows` finestre di adattamento; la velocità dipende solo dal limite attivo."""
+    limits = []
+    for _ in range(windows):
+        scheduler.window_start = time.monotonic() - ftp_backup.SCHEDULER_ADAPT_INTERVAL
+        scheduler.bytes_done = rate_for_limit(scheduler.active_limit) * ftp_backup.SCHEDULER_ADAPT_INTERVAL
+        with scheduler.cond: scheduler._maybe_adapt()
+        limits.append(scheduler.active_limit)
+    return limits
+
+
+def make_scheduler(max_workers=16, active=4):
+    scheduler = ftp_backup.WorkScheduler(max_workers)
+    scheduler.active_limit = active
+    return scheduler
+
+
+def test_flat_throughput_does_not_grow():
+    limits = run_windows(make_scheduler(), lambda limit: 10_000_000, 24)
+    # Ogni tentativo senza guadagno viene annullato, poi si attende prima di riprovare
+    assert max(limits) == 5
+    assert limits[-1] in (4, 5)
+    assert limits.count(5) <= 24 // ftp_backup.WorkScheduler.PROBE_HOLD_WINDOWS
+    assert limits[:3] == [5, 4, 4]
+
+
+def test_rising_throughput_grows_to_max():
+    limits = run_windows(make_scheduler(max_workers=8), lambda limit: limit * 1_000_000, 10)
+    assert limits[:4] == [5, 6, 7, 8]
+    assert limits[-1] == 8
+
+
+def test_errors_during_probe_revert():
+    scheduler = make_scheduler()
+    run_windows(scheduler, lambda limit: 10_000_000, 1)
+    assert scheduler.active_limit == 5 and scheduler.probing
+    scheduler.errors = 1
+    scheduler.last_decrease = time.monotonic()  # Nessun dimezzamento in questa finestra
+    limits = run_windows(scheduler, lambda limit: 50_000_000, 1)
+    assert limits == [4]
+
+
+def test_record_bytes_from_many_threads():
+    scheduler = make_scheduler()
+    threads = [threading.Thread(target=lambda: [scheduler.record_bytes(1) for _ in range(10000)]) for _ in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert scheduler.bytes_done == 80000
@@ -0,0 +1,39 @@
+"""Store deduplicato: il prune non tocca i blob mentre un backup o un ripristino usano lo store."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ftp_backup
+
+
+def snapshot(store_dir, root, files):
+    store = ftp_backup.BlobStore(store_dir, root, 'site', {'site': 'site'})
+    for name, data in files.items(): store.add_file(name, data, 0)
+    store.close()
+    return store
+
+
+def test_prune_removes_unreferenced_blobs(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    os.utime(snapshot(store_dir, str(tmp_path / 'backup_1'), {'a.txt': b'old', 'b.txt': b'same'}).snapshot_path, (1e9, 1e9))
+    snapshot(store_dir, str(tmp_path / 'backup_2'), {'a.txt': b'new', 'b.txt': b'same'})
+    assert ftp_backup.prune_store(store_dir, keep_last=1) == (1, 1, 3)
+
+
+@pytest.mark.skipif(ftp_backup.fcntl is None, reason="flock solo su POSIX")
+def test_prune_refuses_while_store_in_use(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    snapshot(store_dir, str(tmp_path / 'backup_1'), {'a.txt': b'old'})
+    # Un backup in corso tiene il lock condiviso dall'apertura dello store fino allo snapshot definitivo
+    running = ftp_backup.BlobStore(store_dir, str(tmp_path / 'backup_2'), 'site', {'site': 'site'})
+    with pytest.raises(ftp_backup.StoreBusyError):
+        ftp_backup.prune_store(store_dir, keep_last=0)
+    running.close()
+    restore = ftp_backup.StoreLock(store_dir)
+    with pytest.raises(ftp_backup.StoreBusyError):
+        ftp_backup.prune_store(store_dir, keep_last=0)
+    restore.close()
+    assert ftp_backup.prune_store(store_dir, keep_last=0)[0] == 2